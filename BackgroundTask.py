@@ -22,12 +22,16 @@ import time
 import math
 import logging
 import os
-import requests
 
 from urllib.parse import quote
-from typing import Dict, Set
+from concurrent.futures import Future, wait
+from typing import Dict, Set, List, Optional, Tuple
 
+from JsonStream import count_json_array
 from RseData import RseData, EliteSystem
+from TaskQueue import TaskQueue
+from SystemTable import SystemTable, SystemView
+from SpatialIndex import RseRow
 from config import appname, config
 
 logger = logging.getLogger(f"{appname}.{os.path.basename(os.path.dirname(__file__))}")
@@ -36,9 +40,32 @@ logger = logging.getLogger(f"{appname}.{os.path.basename(os.path.dirname(__file_
 class BackgroundTask(object):
     """
     Template for new tasks.
+    prepare is optional and runs on the background worker thread when the task is scheduled, e.g. to take a snapshot
+    of rse_data for fetch. fetch is optional and runs on a thread of the background worker's pool. It may only do I/O
+    and must not change rse_data. execute runs afterwards on the background worker thread. Ordered tasks are executed in the order they
+    were queued, all others as soon as their fetch is done and no task of a higher priority is waiting.
     """
+    ordered = True  # set to False if the task neither reads nor changes rse_data.system_list
+    supersede_key: Optional[str] = None  # a newer task with the same key replaces pending ones, see superseded
+    priority = TaskQueue.PRIORITY_HIGH
+
     def __init__(self, rse_data: RseData):
         self.rse_data = rse_data
+        self.created = time.monotonic()  # used for the wait time of the task
+        self.trace_id = rse_data.tracer.get_trace_id()  # trace of the journal entry that created the task, see Tracer
+
+    def prepare(self):
+        pass  # optional, see class docstring
+
+    def fetch(self):
+        pass  # optional, see class docstring
+
+    def superseded(self) -> Optional["BackgroundTask"]:
+        """
+        Called when a newer task with the same supersede key is queued before this one was executed.
+        :return: a cheaper task that replaces this one or None to drop it
+        """
+        return None
 
     def execute(self):
         logger.critical(f"{self.__class__.__name__} Didn't implement execute.")
@@ -50,35 +77,178 @@ class BackgroundTask(object):
 
 
 class BackgroundTaskClosestSystem(BackgroundTask):
+    EDSM_URL = "https://www.edsm.net/api-v1/systems?onlyUnknownCoordinates=1&"
+
     def __init__(self, rse_data):
         super(BackgroundTaskClosestSystem, self).__init__(rse_data)
 
     def fire_event(self):
         if len(self.rse_data.system_list) > 0:
-            self.rse_data.last_event_info[RseData.BG_RSE_SYSTEM] = self.rse_data.system_list[0]
+            self.rse_data.last_event_info[RseData.BG_RSE_SYSTEM] = self.rse_data.system_list.get_view(self.rse_data.system_list.first(), self.rse_data.projects_dict)
         else:
             self.rse_data.last_event_info[RseData.BG_RSE_SYSTEM] = None
             self.rse_data.last_event_info[RseData.BG_RSE_MESSAGE] = "No system in range"
+        self.rse_data.last_event_info[RseData.BG_TRACE_ID] = self.trace_id
         if self.rse_data.frame and not config.shutting_down:
-            self.rse_data.frame.event_generate(RseData.EVENT_RSE_BACKGROUNDWORKER, when="tail")  # calls updateUI in main thread
-
-    def get_system_from_id(self, id64):
-        system = list(filter(lambda x: x.id64 == id64, self.rse_data.system_list))  # there is only one possible match for ID64, avoid exception being thrown
-        if len(system) > 0:
-            return system[0]
-        else:
+            with self.rse_data.tracer.span("fire_event", event=RseData.EVENT_RSE_BACKGROUNDWORKER):
+                self.rse_data.frame.event_generate(RseData.EVENT_RSE_BACKGROUNDWORKER, when="tail")  # calls updateUI in main thread
+
+    def get_index_from_id(self, id64: int) -> Optional[int]:
+        """ Return the row of the system in rse_data.system_list or None. """
+        return self.rse_data.system_list.find_id64(id64)
+
+    def remove_from_project(self, id64: int, project_id: int) -> bool:
+        """ Remove the system from the project. Returns False if the system isn't part of rse_data.system_list. """
+        index = self.get_index_from_id(id64)
+        if index is None:
+            return False
+        self.rse_data.system_list.remove_from_project(index, project_id)
+        return True
+
+    def get_edsm_batches(self, systems: List[SystemView], confirmed: Set[int] = frozenset(), unknown: Set[int] = frozenset()) -> Tuple[Set[str], List[List[SystemView]]]:
+        """
+        Split the systems that have to be checked into requests. Only reads the caches, so this can be called by fetch.
+        :param confirmed: IDs that EDSM confirmed to have coordinates but that aren't in the caches yet
+        :param unknown: IDs that EDSM reported without coordinates but that aren't in the caches yet
+        :return: names in lower case of the systems that aren't confirmed by the caches and the requests
+        """
+        edsm_url_length = len(BackgroundTaskClosestSystem.EDSM_URL)
+        names = set(system.name.lower() for system in systems)  # everything is unknown until EDSM says otherwise
+        cache = self.rse_data.get_cached_view(RseData.CACHE_EDSM_RSE_QUERY, RseData.CACHE_IGNORED_SYSTEMS)
+        unknown_cache = self.rse_data.get_cached_set(RseData.CACHE_EDSM_RSE_QUERY)
+        confirmed_systems = self.rse_data.get_cached_set(RseData.CACHE_COORDINATES_CONFIRMED)
+        batches: List[List[SystemView]] = list()
+        batch: List[SystemView] = list()
+        url_length = edsm_url_length
+        for system in systems:
+            if system.id64 in confirmed_systems or system.id64 in confirmed:
+                names.discard(system.name.lower())
+                continue
+            if system.uncertainty > 0 and (system.id64 in unknown_cache or system.id64 in unknown):
+                break  # still unknown since the last call, systems further away can't become the target
+            if system.uncertainty == 0 or system.id64 in cache:
+                continue  # name is in EDSM cache -> it is returned as if included in EDSM call
+            param_length = len(f"systemName[]={quote(system.name)}&")
+            if len(batch) >= RseData.EDSM_NUMBER_OF_SYSTEMS_TO_QUERY or (len(batch) > 0 and url_length + param_length > RseData.EDSM_MAX_URL_LENGTH):
+                batches.append(batch)
+                batch = list()
+                url_length = edsm_url_length
+                if len(batches) >= RseData.EDSM_MAX_REQUESTS:
+                    break
+            batch.append(system)
+            url_length += param_length
+        if len(batch) > 0:
+            batches.append(batch)
+        return names, batches
+
+    def request_edsm(self, batches: List[List[SystemView]]) -> List[Tuple[List[int], List[int]]]:
+        """
+        Send the requests in order of distance until a system is confirmed to be unknown. The first request usually
+        finds the target, so the others are only sent once it answered without one or if it takes longer than
+        EDSM_SPECULATIVE_DELAY. If the target is further away, this costs a second round-trip in exchange for one
+        request per jump in the common case. Nothing is changed, so this can be called by fetch.
+        :return: IDs of the unknown and of the known systems for every request that was answered
+        """
+        logger.debug(f"Querying EDSM for {sum(len(batch) for batch in batches)} systems in {len(batches)} requests.")
+        futures: List[Future] = list()
+        if len(batches) > 0:
+            futures.append(self.submit_edsm(batches[0], self.priority))
+            if len(batches) > 1 and not wait(futures, timeout=RseData.EDSM_SPECULATIVE_DELAY).done:
+                self.submit_remaining_edsm(batches, futures)  # slow response, ask about the systems further away meanwhile
+        results = list()
+        for index, batch in enumerate(batches):
+            if index == len(futures):
+                self.submit_remaining_edsm(batches, futures)  # the closer systems weren't targets, second round-trip
+            result = self.read_edsm_response(batch, futures[index])
+            if result is None:
+                break
+            results.append(result)
+            if len(result[0]) > 0:
+                break  # found the closest target, the remaining responses don't change it
+        for future in futures:
+            future.cancel()  # requests that didn't start yet aren't needed anymore, does nothing for the others
+        return results
+
+    def submit_edsm(self, batch: List[SystemView], priority: int) -> Future:
+        return self.rse_data.http.submit(BackgroundTaskClosestSystem.EDSM_URL + "&".join(f"systemName[]={quote(system.name)}" for system in batch), priority=priority)
+
+    def submit_remaining_edsm(self, batches: List[List[SystemView]], futures: List[Future]):
+        # only the first request is needed to find the target, the others are speculative and are dropped first
+        speculative_priority = max(self.priority, TaskQueue.PRIORITY_NORMAL)
+        futures.extend(self.submit_edsm(batch, speculative_priority) for batch in batches[len(futures):])
+
+    def read_edsm_response(self, batch: List[SystemView], future: Future) -> Optional[Tuple[List[int], List[int]]]:
+        """
+        :return: IDs of the unknown and of the known systems of the batch or None if the call failed
+        """
+        try:
+            with self.rse_data.tracer.span("edsm_batch", systems=len(batch)) as span:  # time spent waiting for the response
+                response = future.result()
+                span["status"] = response.status_code
+                if response.status_code != 200:
+                    logger.debug(f"EDSM call failed with status {response.status_code}.")
+                    return None
+                edsm_json = json.loads(response.text)
+                if not isinstance(edsm_json, list):
+                    logger.debug(f"Unexpected response of EDSM: {response.text[:200]}")
+                    return None  # e.g. an error message, the systems must not be marked as confirmed
+                unknown_names = set(entry["name"].lower() for entry in edsm_json)
+                span["unknown"] = len(edsm_json)
+        except Exception as e:
+            # ignore. the EDSM call is not required
+            logger.debug("EDSM call failed.", exc_info=e)
             return None
 
+        # unknown systems are asked again after a while, known ones never change
+        unknown_systems = list()
+        known_systems = list()
+        for system in batch:
+            if system.name.lower() in unknown_names:
+                unknown_systems.append(system.id64)
+            else:
+                known_systems.append(system.id64)
+        return unknown_systems, known_systems
+
+    @staticmethod
+    def get_unknown_names(systems: List[SystemView], names: Set[str], results: List[Tuple[List[int], List[int]]]) -> Set[str]:
+        """
+        :param names: names returned by get_edsm_batches
+        :param results: results of request_edsm
+        :return: set of system names in lower case that are not confirmed to have coordinates
+        """
+        known = set(id64 for _, known_systems in results for id64 in known_systems)
+        names.difference_update(system.name.lower() for system in systems if system.id64 in known)
+        if len(results) > 0:
+            # coordinates of these systems are exact and never queried
+            names.difference_update(system.name.lower() for system in systems if system.uncertainty == 0)
+        return names
+
+    def apply_edsm_results(self, results: List[Tuple[List[int], List[int]]]):
+        """
+        Add the results of request_edsm to the caches.
+        """
+        expiration_time = int(time.time() + 15 * 60)  # ignore for 15 minutes
+        for unknown_systems, known_systems in results:
+            self.rse_data.get_cached_set(RseData.CACHE_EDSM_RSE_QUERY).update(unknown_systems, expiration_time)
+            self.rse_data.add_systems_to_cache(unknown_systems, expiration_time, RseData.CACHE_EDSM_RSE_QUERY)
+            self.rse_data.get_cached_set(RseData.CACHE_COORDINATES_CONFIRMED).update(known_systems)
+            self.rse_data.add_systems_to_cache(known_systems, 2 ** 31 - 1, RseData.CACHE_COORDINATES_CONFIRMED)
+
+    def remove_arrived_system(self, id64: int):
+        index = self.get_index_from_id(id64)
+        if index is not None:  # arrived in system without coordinates
+            logger.debug(f"Arrived in {self.rse_data.system_list.names[index]}.")
+            self.rse_data.system_list.remove_from_project(index, RseData.PROJECT_RSE)
+            self.remove_systems()
+
     def remove_systems(self):
-        remove_me = list(filter(lambda x: len(x.get_project_ids()) == 0, self.rse_data.system_list))
-        logger.debug(f"Adding {len(remove_me)} systems to removal filter: {[x.name for x in remove_me]}.")
-        self.rse_data.system_list = [x for x in self.rse_data.system_list if x not in remove_me]
-        self.rse_data.open_local_database()
-        for system in remove_me:
-            self.rse_data.get_cached_set(RseData.CACHE_IGNORED_SYSTEMS).add(system.id64)
-            self.rse_data.add_system_to_cache(system.id64, int(time.time() + 24 * 3600),
-                                              RseData.CACHE_IGNORED_SYSTEMS, handle_db_connection=False)
-        self.rse_data.close_local_database()
+        remove_me = self.rse_data.system_list.remove_systems_without_projects()
+        logger.debug(f"Adding {len(remove_me)} systems to removal filter: {[name for _, name in remove_me]}.")
+        if len(remove_me) == 0:
+            return
+        expiration_time = int(time.time() + 24 * 3600)
+        self.rse_data.get_cached_set(RseData.CACHE_IGNORED_SYSTEMS).update((id64 for id64, _ in remove_me), expiration_time)
+        self.rse_data.add_systems_to_cache([id64 for id64, _ in remove_me], expiration_time, RseData.CACHE_IGNORED_SYSTEMS)
 
 
 class NavbeaconTask(BackgroundTaskClosestSystem):
@@ -87,96 +257,184 @@ class NavbeaconTask(BackgroundTaskClosestSystem):
         self.system_address = system_address
 
     def execute(self):
-        system = self.get_system_from_id(self.system_address)
-        if system:
-            system.remove_from_project(RseData.PROJECT_NAVBEACON)
+        if self.remove_from_project(self.system_address, RseData.PROJECT_NAVBEACON):
             self.remove_systems()
             self.fire_event()
 
 
+class ArrivedSystemTask(BackgroundTaskClosestSystem):
+    """
+    What is left of a JumpedSystemTask that was superseded by a newer jump: the system doesn't need to be visited anymore.
+    """
+    def __init__(self, rse_data: RseData, system_address: int):
+        super(ArrivedSystemTask, self).__init__(rse_data)
+        self.system_address = system_address
+
+    def execute(self):
+        self.remove_arrived_system(self.system_address)
+
+
 class JumpedSystemTask(BackgroundTaskClosestSystem):
+    supersede_key = "jump"
+
     def __init__(self, rse_data: RseData, elite_system: EliteSystem):
         super(JumpedSystemTask, self).__init__(rse_data)
+        self.elite_system = elite_system
         self.coordinates = elite_system.get_coordinates()
         self.system_address = elite_system.id64
+        self.tile = None
+        self.local_rows: Optional[List[RseRow]] = None  # rows of the spatial index, see prepare
+        self.cached_systems: List[SystemView] = list()  # closest systems of the current list, see prepare
+        self.edsm_results: List[Tuple[List[int], List[int]]] = list()
+
+    def prepare(self):
+        query = self.rse_data.get_query_parameters()
+        if query is not None:
+            radius, flags = query
+            self.local_rows = self.rse_data.get_rows_in_sphere(*self.coordinates, radius, flags, remote=False)
+        # execute falls back to the current list if the remote database can't be reached
+        self.cached_systems = self.rse_data.system_list.get_closest_views(*self.coordinates, RseData.EDSM_NUMBER_OF_SYSTEMS_TO_QUERY * RseData.EDSM_MAX_REQUESTS,
+                                                                          self.rse_data.projects_dict)
+
+    def fetch(self):
+        self.tile = self.rse_data.fetch_tile_around(*self.coordinates)
+        rows = self.tile[1] if self.tile and self.tile is not RseData.FETCH_FAILED else self.local_rows
+        query = self.rse_data.get_query_parameters()
+        closest_systems = self.cached_systems  # execute keeps the current list if there are no new systems
+        if rows is not None and query is not None:
+            systems, _ = self.rse_data.filter_rows(rows, *self.coordinates, query[0])
+            if systems is not None:
+                closest_systems = [systems.get_view(i, self.rse_data.projects_dict)
+                                   for i in systems.rows(RseData.EDSM_NUMBER_OF_SYSTEMS_TO_QUERY * RseData.EDSM_MAX_REQUESTS)]
+        if len(closest_systems) == 0:
+            return
+        _, batches = self.get_edsm_batches(closest_systems)
+        self.edsm_results = self.request_edsm(batches)
 
-    def query_edsm(self, systems) -> Set[str]:
-        """ returns a set of systems names in lower case with unknown coordinates """
-        edsm_url = "https://www.edsm.net/api-v1/systems?onlyUnknownCoordinates=1&"
-        params = list()
-        names = set()
-        cache = self.rse_data.get_cached_set(RseData.CACHE_EDSM_RSE_QUERY)  # type: set
-        cache = cache.union(self.rse_data.get_cached_set(RseData.CACHE_IGNORED_SYSTEMS))
-        add_to_cache = list()
-        for system in systems:
-            if system.uncertainty > 0:
-                if system.id64 not in cache:
-                    params.append(f"systemName[]={quote(system.name)}")
-                    add_to_cache.append(system.id64)
-                else:
-                    names.add(system.name.lower())  # name is in EDSM cache -> make sure the name is returned as if included in EDSM call
-        edsm_url += "&".join(params)
-
-        logger.debug(f"Querying EDSM for {len(params)} systems.")
-
-        if len(params) > 0:
-            try:
-                response = requests.get(edsm_url, timeout=10)
-                edsm_json = json.loads(response.text)
-                for entry in edsm_json:
-                    names.add(entry["name"].lower())
-
-                expiration_time = int(time.time() + 15 * 60)  # ignore for 15 minutes
-                self.rse_data.open_local_database()
-                for id64 in add_to_cache:
-                    self.rse_data.add_system_to_cache(id64, expiration_time, RseData.CACHE_EDSM_RSE_QUERY, handle_db_connection=False)
-                self.rse_data.close_local_database()
-
-                return names
-            except Exception as e:
-                # ignore. the EDSM call is not required
-                logger.debug("EDSM call failed.", exc_info=e)
-
-        # something went wrong. Return all systems as unknown
-        names = set()
-        for system in systems:
-            names.add(system.name.lower())
-        return names
+    def superseded(self) -> Optional[BackgroundTask]:
+        arrived_system_task = ArrivedSystemTask(self.rse_data, self.system_address)
+        arrived_system_task.trace_id = self.trace_id
+        return arrived_system_task
 
     def execute(self):
-        system = self.get_system_from_id(self.system_address)
-
-        if system:  # arrived in system without coordinates
-            logger.debug(f"Arrived in {system.name}.")
-            system.remove_from_project(RseData.PROJECT_RSE)
-            self.remove_systems()
-
-        if not self.rse_data.generate_lists_from_remote_database(*self.coordinates):
+        self.rse_data.current_system = self.elite_system
+        fetch_failed = self.tile is RseData.FETCH_FAILED
+        if self.tile and not fetch_failed:
+            self.rse_data.store_tile(*self.tile)
+        self.apply_edsm_results(self.edsm_results)  # before the list is built, so confirmed systems are left out
+        self.remove_arrived_system(self.system_address)
+
+        # don't wait for the remote database a second time if it didn't answer the fetch
+        if not self.rse_data.generate_lists_from_remote_database(*self.coordinates, remote=not fetch_failed):
             # distances need to be recalculated because we couldn't get a new list from the database
             logger.debug(f"Using cached system list for targets. Radius was set to {self.rse_data.calculate_radius()}.")
-            for system in self.rse_data.system_list:
-                system.update_distance_to_current_commander_position(*self.coordinates)
-            self.rse_data.system_list.sort(key=lambda l: l.distance)
+            self.rse_data.system_list.sort_by_distance(*self.coordinates)
         self.rse_data.adjust_radius_exponent()
 
-        tries = 0
-        while tries < 3 and len(self.rse_data.system_list) > 0:  # no do-while loops...
-            closestSystems = self.rse_data.system_list[0:RseData.EDSM_NUMBER_OF_SYSTEMS_TO_QUERY]
-            edsmResults = self.query_edsm(closestSystems)
-            if len(edsmResults) > 0:
-                # remove systems with coordinates
-                systemsWithCoordinates = filter(lambda s: s.name.lower() not in edsmResults, closestSystems)
-                for system in systemsWithCoordinates:
-                    system.remove_from_project(RseData.PROJECT_RSE)
-                self.remove_systems()
-            if len(edsmResults) < len(closestSystems):
-                # there are still systems to jump into -> stop here
-                break
-            tries += 1
+        system_list = self.rse_data.system_list
+        closest_systems = [system_list.get_view(i, self.rse_data.projects_dict)
+                           for i in system_list.rows(RseData.EDSM_NUMBER_OF_SYSTEMS_TO_QUERY * RseData.EDSM_MAX_REQUESTS)]
+        if len(closest_systems) > 0:
+            confirmed_systems = self.rse_data.get_cached_set(RseData.CACHE_COORDINATES_CONFIRMED)
+            names = set(system.name.lower() for system in closest_systems if system.id64 not in confirmed_systems)
+            unknown_names = self.get_unknown_names(closest_systems, names, self.edsm_results)
+            # remove systems with coordinates
+            for system in closest_systems:
+                if system.name.lower() not in unknown_names:
+                    self.remove_from_project(system.id64, RseData.PROJECT_RSE)
+            self.remove_systems()
 
         self.fire_event()
 
 
+class PrefetchTask(BackgroundTaskClosestSystem):
+    """
+    Look up targets around the next systems of the plotted route while the commander is still in hyperspace. The
+    remote results end up in the spatial index and the EDSM results in the caches, so the JumpedSystemTask after the
+    jump is answered locally.
+    """
+    ordered = False
+    supersede_key = "prefetch"
+    priority = TaskQueue.PRIORITY_NORMAL
+
+    def __init__(self, rse_data: RseData, route: List[EliteSystem]):
+        super(PrefetchTask, self).__init__(rse_data)
+        self.route = route[:RseData.PREFETCH_HOPS]
+        self.local_rows: List[Optional[List[RseRow]]] = list()  # rows of the spatial index for every hop, see prepare
+        self.tiles = list()
+        self.edsm_results: List[Tuple[List[int], List[int]]] = list()
+        self.confirmed_ids: Set[int] = set()  # answers of EDSM that aren't in the caches until execute
+        self.unknown_ids: Set[int] = set()
+        self.removed_systems: List[Tuple[int, str]] = list()
+        self.observations: List[Tuple[int, float, float, frozenset]] = list()  # arguments of RadiusController.observe
+
+    def prepare(self):
+        query = self.rse_data.get_query_parameters()
+        if query is None:
+            return
+        radius, flags = query
+        # the spatial index is changed by the background worker, fetch only gets the rows of the covered hops
+        self.local_rows = [self.rse_data.get_rows_in_sphere(*elite_system.get_coordinates(), radius, flags, remote=False)
+                           for elite_system in self.route]
+
+    def fetch(self):
+        query = self.rse_data.get_query_parameters()
+        if query is None:
+            return
+        radius, flags = query
+        for index, elite_system in enumerate(self.route):
+            x, y, z = elite_system.get_coordinates()
+            rows = self.local_rows[index] if index < len(self.local_rows) else None
+            if rows is None:
+                rows = next((rows for covered_sphere, rows in self.tiles if covered_sphere.contains(x, y, z, radius, frozenset(flags))), None)
+            if rows is None:
+                tile = self.rse_data.fetch_tile_around(x, y, z)
+                if tile is None or tile is RseData.FETCH_FAILED:
+                    continue  # covered since prepare or not reachable, the JumpedSystemTask after the jump checks EDSM
+                self.tiles.append(tile)
+                rows = tile[1]
+            systems, systems_radius = self.rse_data.filter_rows(rows, x, y, z, radius)
+            self.observations.append((len(systems) if systems else 0, y, systems_radius, frozenset(flags)))
+            if systems is None:
+                continue
+            self.check_edsm(systems)
+            logger.debug(f"Prefetched {len(systems)} systems around {elite_system.name}.")
+
+    def check_edsm(self, systems: SystemTable):
+        """
+        Ask EDSM about the closest systems, so the JumpedSystemTask after the jump finds the answers in the caches.
+        Systems that were answered for a previous hop aren't asked again. The table belongs to this task, the caches
+        are only changed by execute.
+        """
+        closest_systems = [systems.get_view(i, self.rse_data.projects_dict)
+                           for i in systems.rows(RseData.EDSM_NUMBER_OF_SYSTEMS_TO_QUERY * RseData.EDSM_MAX_REQUESTS)]
+        names, batches = self.get_edsm_batches(closest_systems, self.confirmed_ids, self.unknown_ids)
+        results = self.request_edsm(batches)
+        self.edsm_results.extend(results)
+        for unknown_systems, known_systems in results:
+            self.unknown_ids.update(unknown_systems)
+            self.confirmed_ids.update(known_systems)
+        unknown_names = self.get_unknown_names(closest_systems, names, results)
+        for system in closest_systems:
+            if system.name.lower() not in unknown_names:
+                systems.remove_from_project(systems.find_id64(system.id64), RseData.PROJECT_RSE)
+        self.removed_systems.extend(systems.remove_systems_without_projects())
+
+    def execute(self):
+        for tile in self.tiles:
+            self.rse_data.store_tile(*tile)
+        for observation in self.observations:
+            self.rse_data.radius_controller.observe(*observation)
+        self.apply_edsm_results(self.edsm_results)
+        if len(self.removed_systems) > 0:
+            expiration_time = int(time.time() + 24 * 3600)
+            self.rse_data.get_cached_set(RseData.CACHE_IGNORED_SYSTEMS).update((id64 for id64, _ in self.removed_systems), expiration_time)
+            self.rse_data.add_systems_to_cache([id64 for id64, _ in self.removed_systems], expiration_time, RseData.CACHE_IGNORED_SYSTEMS)
+
+    def fire_event(self):
+        pass  # nothing changed for the current system
+
+
 class IgnoreSystemTask(BackgroundTaskClosestSystem):
     """
     Ignore a system name once, for the current EDSM session, or for a period of time.
@@ -189,41 +447,54 @@ class IgnoreSystemTask(BackgroundTaskClosestSystem):
         self.once = once
 
     def execute(self):
-        for system in self.rse_data.system_list:
-            if system.name.lower() == self.system_name.lower():
-                self.rse_data.system_list.remove(system)
-                if not self.once:
-                    self.rse_data.get_cached_set(RseData.CACHE_IGNORED_SYSTEMS).add(system.id64)
-                    if self.duration > 0:
-                        self.rse_data.add_system_to_cache(system.id64, self.duration, RseData.CACHE_IGNORED_SYSTEMS)
-
-                self.fire_event()
-                break
+        index = self.rse_data.system_list.find_name(self.system_name)
+        if index is not None:
+            id64, _ = self.rse_data.system_list.remove_rows({index})[0]
+            if not self.once:
+                if self.duration > 0:
+                    self.rse_data.get_cached_set(RseData.CACHE_IGNORED_SYSTEMS).add(id64, self.duration)
+                    self.rse_data.add_system_to_cache(id64, self.duration, RseData.CACHE_IGNORED_SYSTEMS)
+                else:
+                    self.rse_data.get_cached_set(RseData.CACHE_IGNORED_SYSTEMS).add(id64)  # for this session only
+
+            self.fire_event()
 
 
 class VersionCheckTask(BackgroundTask):
+    ordered = False
+    priority = TaskQueue.PRIORITY_LOW
+
     def __init__(self, rse_data: RseData):
         super(VersionCheckTask, self).__init__(rse_data)
+        self.new_version_info: Optional[Dict[str, str]] = None
 
-    def execute(self):
+    def fetch(self):
         try:
-            response = requests.get(RseData.VERSION_CHECK_URL, timeout=10)
+            response = self.rse_data.http.get(RseData.VERSION_CHECK_URL, priority=self.priority)
             releases_info = json.loads(response.text)
             running_version = tuple(RseData.VERSION.split("."))
             for release_info in releases_info:
                 if not release_info["draft"] and not release_info["prerelease"]:
                     new_version_text = release_info["tag_name"].split("_")[1]
                     new_version_info = tuple(new_version_text.split("."))
-                    if running_version < new_version_info and not config.shutting_down:
-                        self.rse_data.last_event_info[RseData.BG_UPDATE_JSON] = {"version": new_version_text, "url": release_info["html_url"]}
-                        self.rse_data.frame.event_generate(RseData.EVENT_RSE_UPDATE_AVAILABLE, when="tail")
+                    if running_version < new_version_info:
+                        self.new_version_info = {"version": new_version_text, "url": release_info["html_url"]}
                         break
         except Exception as e:
             logger.exception("Failed to retrieve information about available updates.")
 
+    def execute(self):
+        if self.new_version_info and not config.shutting_down:
+            self.rse_data.last_event_info[RseData.BG_UPDATE_JSON] = self.new_version_info
+            self.rse_data.frame.event_generate(RseData.EVENT_RSE_UPDATE_AVAILABLE, when="tail")
+
 
 class TimedTask(BackgroundTask):
     # the reason this class exists is to use the task queue for the timer
+    ordered = False
+    supersede_key = "timer"
+    priority = TaskQueue.PRIORITY_LOW
+
     def __init__(self, rse_data: RseData):
         super(TimedTask, self).__init__(rse_data)
 
@@ -231,7 +502,29 @@ class TimedTask(BackgroundTask):
         self.rse_data.remove_expired_systems_from_caches()
 
 
+class UpdateProjectsTask(BackgroundTask):
+    """
+    Apply information about projects that was fetched outside of the background worker.
+    """
+    def __init__(self, rse_data: RseData, response: List[Dict]):
+        super(UpdateProjectsTask, self).__init__(rse_data)
+        self.response = response
+
+    def execute(self):
+        had_projects = len(self.rse_data.projects_dict) > 0
+        self.rse_data.set_projects(self.response)
+        logger.debug(f"Updated information about {len(self.response)} projects.")
+        if not had_projects and self.rse_data.current_system:
+            # first start, the jumps so far couldn't search for any systems
+            jumped_system_task = JumpedSystemTask(self.rse_data, self.rse_data.current_system)
+            jumped_system_task.trace_id = self.trace_id
+            self.rse_data.background_queue.put(jumped_system_task)
+
+
 class DeleteSystemsFromCacheTask(BackgroundTask):
+    ordered = False
+    priority = TaskQueue.PRIORITY_LOW
+
     def __init__(self, rse_data, cache_type: int):
         super(DeleteSystemsFromCacheTask, self).__init__(rse_data)
         self.cacheType = cache_type
@@ -243,11 +536,80 @@ class DeleteSystemsFromCacheTask(BackgroundTask):
 class EdsmBodyCheck(BackgroundTaskClosestSystem):
     def __init__(self, rse_data: RseData):
         super(EdsmBodyCheck, self).__init__(rse_data)
+        self.owns_body_count_request = False  # True if this task sent the request, see request_body_count
 
     def fire_event_edsm_body_check(self, message=None):
         self.rse_data.last_event_info[RseData.BG_EDSM_BODY] = message or "?"
+        self.rse_data.last_event_info[RseData.BG_TRACE_ID] = self.trace_id
         if self.rse_data.frame and not config.shutting_down:
-            self.rse_data.frame.event_generate(RseData.EVENT_RSE_EDSM_BODY_COUNT, when="tail")  # calls updateUI in main thread
+            with self.rse_data.tracer.span("fire_event", event=RseData.EVENT_RSE_EDSM_BODY_COUNT):
+                self.rse_data.frame.event_generate(RseData.EVENT_RSE_EDSM_BODY_COUNT, when="tail")  # calls updateUI in main thread
+
+    def query_body_count(self, system_name: str) -> Optional[int]:
+        """
+        Ask EDSM for the bodies of a system. The bodies are only counted, not parsed.
+        :return: number of bodies known to EDSM or None if the call failed
+        """
+        edsm_url = f"https://www.edsm.net/api-system-v1/bodies?systemName={quote(system_name)}"
+        logger.debug(f"Querying EDSM for bodies of system {system_name}.")
+        try:
+            response = self.rse_data.http.get(edsm_url, priority=self.priority)
+            return count_json_array(response.text, "bodies")
+        except Exception as e:
+            logger.debug("EDSM body count call failed.", exc_info=e)
+        return None  # error/timeout occurred
+
+    def request_body_count(self, id64: int, system_name: str) -> Optional[int]:
+        """
+        Same as query_body_count but waits for the request of another task for the same system instead of
+        sending a second one, e.g. of a BodyCountPrefetchTask. The request is shared until its task stored the result
+        in body_counts and called finish_body_count_request. Can be called by fetch.
+        """
+        with self.rse_data.body_count_lock:
+            future = self.rse_data.body_count_requests.get(id64)
+            running = future is not None
+            if not running:
+                future = Future()
+                self.rse_data.body_count_requests[id64] = future
+                self.owns_body_count_request = True
+        if running:
+            return future.result()
+
+        body_count = None
+        try:
+            body_count = self.query_body_count(system_name)
+        finally:
+            future.set_result(body_count)
+        return body_count
+
+    def finish_body_count_request(self, id64: int):
+        if self.owns_body_count_request:
+            with self.rse_data.body_count_lock:
+                self.rse_data.body_count_requests.pop(id64, None)
+
+
+class BodyCountPrefetchTask(EdsmBodyCheck):
+    """
+    Get the body count of a system before the discovery scan, e.g. while jumping to it.
+    The result is kept in RseData.body_counts and shown by the FSSDiscoveryScanTask.
+    """
+    ordered = False
+    priority = TaskQueue.PRIORITY_NORMAL
+
+    def __init__(self, rse_data: RseData, id64: int, system_name: str):
+        super(BodyCountPrefetchTask, self).__init__(rse_data)
+        self.id64 = id64
+        self.system_name = system_name
+        self.known_to_edsm: Optional[int] = None
+
+    def fetch(self):
+        if self.id64 not in self.rse_data.body_counts:
+            self.known_to_edsm = self.request_body_count(self.id64, self.system_name)
+
+    def execute(self):
+        if self.known_to_edsm is not None:
+            self.rse_data.body_counts.put(self.id64, self.known_to_edsm)
+        self.finish_body_count_request(self.id64)
 
 
 class FSSAllBodiesFoundTask(EdsmBodyCheck):
@@ -257,45 +619,51 @@ class FSSAllBodiesFoundTask(EdsmBodyCheck):
         self.edsm_body_check = edsm_body_check
 
     def execute(self):
-        system = self.get_system_from_id(self.id64)
-        if system:
-            system.remove_from_project(RseData.PROJECT_SCAN)
+        if self.remove_from_project(self.id64, RseData.PROJECT_SCAN):
             self.remove_systems()
             self.fire_event()
 
         if self.edsm_body_check:
-            self.rse_data.add_system_to_cache(self.id64, 2 ** 31 - 1, RseData.CACHE_FULLY_SCANNED_BODIES)  # overwrites entry in DB if it was set before
+            self.rse_data.get_cached_set(RseData.CACHE_FULLY_SCANNED_BODIES).add(self.id64)
+            self.rse_data.add_system_to_cache(self.id64, 2 ** 31 - 1, RseData.CACHE_FULLY_SCANNED_BODIES)  # replaces an earlier entry of this system in the same cache
             self.fire_event_edsm_body_check("System complete")
 
 
 class FSSDiscoveryScanTask(EdsmBodyCheck):
-    def __init__(self, rse_data: RseData, system_name: str, body_count: int, progress: float):
+    ordered = False
+
+    def __init__(self, rse_data: RseData, id64: int, system_name: str, body_count: int, progress: float):
         super(FSSDiscoveryScanTask, self).__init__(rse_data)
+        self.id64 = id64
         self.system_name = system_name
         self.body_count = body_count
         self.progress = progress
+        self.known_to_edsm: Optional[int] = None
+        self.fetched = False
 
-    def query_edsm(self):
-        edsm_url = f"https://www.edsm.net/api-system-v1/bodies?systemName={quote(self.system_name)}"
-        logger.debug(f"Querying EDSM for bodies of system {self.system_name}.")
-        try:
-            response = requests.get(edsm_url, timeout=10)
-            edsm_json = json.loads(response.text)
-            return edsm_json["id64"], len(edsm_json["bodies"])
-        except Exception as e:
-            logger.debug("EDSM body count call failed.", exc_info=e)
-        return None, None  # error/timeout occurred
+    def fetch(self):
+        # no need to call EDSM's API if all bodies are found because they will be submitted to EDSM
+        # or if the body count was prefetched, see BodyCountPrefetchTask
+        if self.progress != 1.0 and self.id64 not in self.rse_data.body_counts:
+            self.known_to_edsm = self.request_body_count(self.id64, self.system_name)
+            self.fetched = True
 
     def execute(self):
         if self.progress == 1.0:
             self.fire_event_edsm_body_check("System complete")
-            # no need to call EDSM's API here because all bodies are found and will be submitted to EDSM
             return
 
-        id64, known_to_edsm = self.query_edsm()
-        if id64:
-            if self.body_count == known_to_edsm:
-                self.rse_data.add_system_to_cache(id64, int(math.pow(2, 31)) - 1, RseData.CACHE_FULLY_SCANNED_BODIES)
-            self.fire_event_edsm_body_check(f"{known_to_edsm}/{self.body_count}")
+        if self.fetched:
+            if self.known_to_edsm is not None:
+                self.rse_data.body_counts.put(self.id64, self.known_to_edsm)
+            self.finish_body_count_request(self.id64)
+        else:
+            self.known_to_edsm = self.rse_data.body_counts.get(self.id64)
+
+        if self.known_to_edsm is not None:
+            if self.body_count == self.known_to_edsm:
+                self.rse_data.get_cached_set(RseData.CACHE_FULLY_SCANNED_BODIES).add(self.id64)
+                self.rse_data.add_system_to_cache(self.id64, int(math.pow(2, 31)) - 1, RseData.CACHE_FULLY_SCANNED_BODIES)
+            self.fire_event_edsm_body_check(f"{self.known_to_edsm}/{self.body_count}")
         else:
             self.fire_event_edsm_body_check(f"?/{self.body_count}")
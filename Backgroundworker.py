@@ -18,52 +18,251 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
 from threading import Thread, Timer
-from BackgroundTask import TimedTask
-from queue import Queue
+from BackgroundTask import BackgroundTask, TimedTask, UpdateProjectsTask
+from queue import Empty
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Deque, List, Optional, Tuple
 import os
+import time
 import traceback
 import logging
 
 from RseData import RseData
+from TaskQueue import TaskQueue, WaitStatistics, supersede
 from config import appname
 logger = logging.getLogger(f"{appname}.{os.path.basename(os.path.dirname(__file__))}")
 
 
 class BackgroundWorker(Thread):
-    def __init__(self, queue: Queue, rse_data: RseData, interval: int = 60 * 15):
+    """
+    Executes the queued tasks. The I/O of a task (BackgroundTask.fetch) runs on a small thread pool, so a slow remote
+    call doesn't block the following tasks. Changes to RseData (BackgroundTask.execute) are only made by this thread.
+    Tasks of a lower priority are only executed while no task of a higher priority is waiting for its fetch, unless
+    they waited for TaskQueue.MAX_WAIT seconds already.
+    """
+
+    FETCH_THREADS = 4
+    FETCH_DONE = object()  # queued when a fetch finished to wake up the worker
+
+    def __init__(self, queue: TaskQueue, rse_data: RseData, interval: int = 60 * 15):
         Thread.__init__(self)
         self.queue = queue
         self.rse_data = rse_data
+        self.rse_data.background_queue = queue
         self.interval = interval  # in seconds
         self.timer = None
+        self.pool: Optional[ThreadPoolExecutor] = None
+        self.ordered_tasks: Deque[Tuple[BackgroundTask, Optional[Future]]] = deque()  # executed in this order
+        self.unordered_tasks: List[Tuple[BackgroundTask, Optional[Future]]] = list()
+        self.wait_statistics = WaitStatistics()
 
     def timer_task(self):
         logging.debug("TimerTask triggered.")
         self.timer = Timer(self.interval, self.timer_task)
         self.timer.daemon = True
         self.timer.start()
+        logger.debug(f"Wait time of background tasks: {self.wait_statistics}.")
+        self.dump_metrics()
         self.queue.put(TimedTask(self.rse_data))
 
+    def dump_metrics(self):
+        metrics = self.rse_data.metrics
+        logger.debug("Metrics of the background worker:\n" + "\n".join(metrics.get_summary()))
+        try:
+            metrics.dump(self.rse_data.plugin_dir)
+        except OSError as e:
+            logger.debug("Failed to write metrics.", exc_info=e)
+
+    def flush_pending_writes(self, only_if_due: bool = False):
+        try:
+            if only_if_due:
+                self.rse_data.flush_pending_writes_if_due()
+            else:
+                self.rse_data.flush_pending_writes()
+        except Exception as e:
+            logger.exception("Failed to write buffered changes to the local database.")
+
+    def refresh_projects(self):
+        response = self.rse_data.fetch_projects()
+        if response:
+            self.queue.put(UpdateProjectsTask(self.rse_data, response))
+
+    def fetch(self, task: BackgroundTask):
+        name = task.__class__.__name__
+        tracer = self.rse_data.tracer
+        try:
+            with tracer.trace(task.trace_id), tracer.span("fetch", task=name), self.rse_data.metrics.timer(f"task_fetch.{name}"):
+                task.fetch()
+        except Exception as e:
+            self.rse_data.metrics.increment(f"task_errors.{name}")
+            logger.exception("Exception occurred while fetching data for background task {bg}.".format(bg=name))
+
+    def supersede_scheduled(self, task: BackgroundTask):
+        """
+        Apply the supersede key of a new task to the tasks that were taken from the queue but weren't executed yet.
+        The result of a running fetch is simply ignored.
+        """
+        if task.supersede_key is None:
+            return
+
+        def replace(entries):
+            for pending, future in entries:
+                replacement = supersede(pending, task)
+                if replacement is not None:
+                    yield replacement, future if replacement is pending else None
+
+        self.ordered_tasks = deque(replace(self.ordered_tasks))
+        self.unordered_tasks = list(replace(self.unordered_tasks))
+
+    def schedule(self, task: BackgroundTask):
+        if self.rse_data.tracer.enabled:
+            wait_time = time.monotonic() - task.created
+            self.rse_data.tracer.record("queue", time.time() - wait_time, wait_time, task.trace_id, task=task.__class__.__name__, priority=task.priority)
+        self.supersede_scheduled(task)
+        try:
+            task.prepare()
+        except Exception as e:
+            self.rse_data.metrics.increment(f"task_errors.{task.__class__.__name__}")
+            logger.exception("Exception occurred while preparing background task {bg}.".format(bg=task.__class__.__name__))
+        future = None
+        if task.__class__.fetch is not BackgroundTask.fetch:
+            future = self.pool.submit(self.fetch, task)
+            future.add_done_callback(lambda f: self.queue.put(BackgroundWorker.FETCH_DONE))
+        if task.ordered:
+            self.ordered_tasks.append((task, future))
+        else:
+            self.unordered_tasks.append((task, future))
+
+    def execute(self, task: BackgroundTask):
+        name = task.__class__.__name__
+        metrics = self.rse_data.metrics
+        wait_time = time.monotonic() - task.created
+        self.wait_statistics.add(task.priority, wait_time)
+        metrics.observe(f"task_wait.{name}", wait_time)  # includes the fetch
+        metrics.increment(f"tasks.{name}")
+        tracer = self.rse_data.tracer
+        try:
+            with tracer.trace(task.trace_id), tracer.span("execute", task=name), metrics.timer(f"task_run.{name}"), \
+                    self.rse_data.transaction():  # all writes of a task are committed at once
+                task.execute()
+        except Exception as e:
+            metrics.increment(f"task_errors.{name}")
+            logger.exception("Exception occurred in background task {bg}.".format(bg=name))
+            traceback.print_exc()
+        if isinstance(task, TimedTask):
+            self.flush_pending_writes()  # the periodic flush, can't be done within the transaction of the task
+
+    def execute_fetched_tasks(self):
+        while True:
+            task = self.pop_next_task()
+            if task is None:
+                return
+            self.execute(task)
+
+    def pop_next_task(self) -> Optional[BackgroundTask]:
+        """
+        Remove the next task that can be executed from the scheduled tasks.
+        :return: the task or None if all tasks are still fetching or have to wait for tasks of a higher priority
+        """
+        ready = [entry for entry in self.unordered_tasks if entry[1] is None or entry[1].done()]
+        if self.ordered_tasks and (self.ordered_tasks[0][1] is None or self.ordered_tasks[0][1].done()):
+            ready.append(self.ordered_tasks[0])
+        if len(ready) == 0:
+            return None
+
+        now = time.monotonic()
+
+        def waited_too_long(task: BackgroundTask) -> bool:
+            return now - task.created >= TaskQueue.MAX_WAIT
+
+        def get_priority(entry: Tuple[BackgroundTask, Optional[Future]]) -> int:
+            if waited_too_long(entry[0]):
+                return TaskQueue.PRIORITY_HIGH - 1
+            if self.ordered_tasks and self.ordered_tasks[0] is entry:
+                return min(pending.priority for pending, _ in self.ordered_tasks)  # the following ordered tasks wait for it
+            return entry[0].priority
+
+        entry = min(ready, key=lambda e: (get_priority(e), e[0].created))
+        task = entry[0]
+        priority = get_priority(entry)
+        for pending, future in list(self.ordered_tasks) + self.unordered_tasks:
+            if pending.priority < priority and future is not None and not future.done():
+                return None  # wait until the more important task is fetched
+
+        if self.ordered_tasks and self.ordered_tasks[0] is entry:
+            self.ordered_tasks.popleft()
+        else:
+            self.unordered_tasks.remove(entry)
+        return task
+
+    def drain(self):
+        """
+        Execute all tasks that are still queued or scheduled, waiting for their fetches. Called when the worker stops.
+        """
+        while True:
+            try:
+                while True:
+                    task = self.queue.get(block=False)
+                    if task and task is not BackgroundWorker.FETCH_DONE:
+                        self.schedule(task)
+            except Empty:
+                pass
+            self.execute_fetched_tasks()
+            if len(self.ordered_tasks) == 0 and len(self.unordered_tasks) == 0:
+                return
+            fetching = [future for _, future in list(self.ordered_tasks) + self.unordered_tasks if future is not None and not future.done()]
+            if fetching:
+                wait(fetching, return_when=FIRST_COMPLETED)
+
+    def get_next_task(self):
+        if self.rse_data.is_loading():
+            timeout = 0  # continue loading local data if there is nothing else to do
+        elif self.rse_data.has_pending_writes():
+            timeout = RseData.WRITE_BEHIND_MAX_DELAY  # wake up in time to write buffered changes to the local database
+        else:
+            timeout = None
+        return self.queue.get(timeout=timeout)
+
     def run(self):
-        self.rse_data.initialize()
+        self.pool = ThreadPoolExecutor(max_workers=BackgroundWorker.FETCH_THREADS, thread_name_prefix="EDSM-RSE Fetch")
+        if self.rse_data.initialize():
+            self.pool.submit(self.refresh_projects)  # a slow remote database doesn't block the first tasks
         self.timer = Timer(self.interval, self.timer_task)
         self.timer.daemon = True
         self.timer.start()
         while True:
-            task = self.queue.get()
+            try:
+                task = self.get_next_task()
+            except Empty:
+                if self.rse_data.is_loading():
+                    try:
+                        self.rse_data.load_next_chunk()
+                    except Exception as e:
+                        logger.exception("Failed to load local data.")
+                else:
+                    self.flush_pending_writes()
+                continue
             if not task:
                 break
-            else:
-                try:
-                    task.execute()
-                except Exception as e:
-                    logger.exception("Exception occurred in background task {bg}.".format(bg=task.__class__.__name__))
-                    traceback.print_exc()
+            elif task is not BackgroundWorker.FETCH_DONE:
+                self.schedule(task)
+                self.rse_data.metrics.set_gauge("queue.depth", len(self.queue) + len(self.ordered_tasks) + len(self.unordered_tasks))
+            self.execute_fetched_tasks()
 
             self.queue.task_done()
+            self.flush_pending_writes(only_if_due=True)  # after the task fired its event, UI updates don't wait for the disk
 
         if self.timer:
             logger.debug("Stopping RSE background timer.")
             self.timer.cancel()
             self.timer.join()
+        self.drain()
+        logger.debug(f"Wait time of background tasks: {self.wait_statistics}.")
+        self.dump_metrics()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.flush_pending_writes()
+        self.rse_data.close_local_database()
+        self.rse_data.http.close()
+        self.rse_data.tracer.disable()
         self.queue.task_done()
@@ -0,0 +1,76 @@
+"""
+EDSM-RSE a plugin for EDMC
+Copyright (C) 2019 Sebastian Bauer
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import math
+
+from array import array
+from typing import Iterable, List, Tuple, Union
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # EDMC doesn't ship NumPy, fall back to the array module
+
+
+class CoordinateArrays(object):
+    """
+    Coordinates and project flags of many systems in contiguous arrays.
+    Used to filter and sort a batch of systems by distance in one pass instead of creating an object for every system.
+    """
+
+    def __init__(self, coordinates: Iterable[Tuple[float, float, float, int]]):
+        """
+        :param coordinates: iterable of (x, y, z, action)
+        """
+        xs, ys, zs, actions = array("d"), array("d"), array("d"), array("l")
+        for x, y, z, action in coordinates:
+            xs.append(x)
+            ys.append(y)
+            zs.append(z)
+            actions.append(action)
+
+        if numpy:
+            self.xs = numpy.frombuffer(xs, dtype=numpy.float64) if len(xs) else numpy.empty(0)
+            self.ys = numpy.frombuffer(ys, dtype=numpy.float64) if len(ys) else numpy.empty(0)
+            self.zs = numpy.frombuffer(zs, dtype=numpy.float64) if len(zs) else numpy.empty(0)
+            self.actions = numpy.array(actions, dtype=numpy.int64)
+        else:
+            self.xs, self.ys, self.zs, self.actions = xs, ys, zs, actions
+
+    def __len__(self):
+        return len(self.xs)
+
+    def nearest(self, x: Union[int, float], y: Union[int, float], z: Union[int, float], radius: float = math.inf,
+                action_mask: int = -1) -> List[Tuple[int, float]]:
+        """
+        Find all systems within radius that are part of at least one project of action_mask.
+
+        :return: list of (index, distance), sorted by distance
+        """
+        squared_radius = radius * radius
+        if numpy:
+            squared_distances = (self.xs - x) ** 2 + (self.ys - y) ** 2 + (self.zs - z) ** 2
+            indices = numpy.nonzero((squared_distances <= squared_radius) & ((self.actions & action_mask) != 0))[0]
+            indices = indices[numpy.argsort(squared_distances[indices], kind="stable")]
+            return list(zip(indices.tolist(), numpy.sqrt(squared_distances[indices]).tolist()))
+
+        candidates = [(index, d) for index, d in enumerate((sx - x) ** 2 + (sy - y) ** 2 + (sz - z) ** 2 for sx, sy, sz in zip(self.xs, self.ys, self.zs))
+                      if d <= squared_radius and self.actions[index] & action_mask]
+        candidates.sort(key=lambda candidate: candidate[1])
+        return [(index, math.sqrt(d)) for index, d in candidates]
@@ -0,0 +1,306 @@
+"""
+EDSM-RSE a plugin for EDMC
+Copyright (C) 2019 Sebastian Bauer
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import math
+import random
+import threading
+import time
+
+import requests
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from typing import Callable, Dict, List, Optional, Union
+from urllib.parse import urlsplit
+
+from Metrics import MetricsRegistry
+from Tracer import Tracer
+
+
+class EndpointUnavailable(requests.exceptions.ConnectionError):
+    """
+    Raised instead of sending a request while the circuit breaker of the host is open.
+    """
+
+
+class RateLimited(requests.exceptions.RequestException):
+    """
+    Raised instead of sending a request that would use up the remaining rate limit of the host.
+    """
+
+
+class TokenBucket(object):
+    """
+    Request budget of one host. Hosts that send X-Rate-Limit-Limit, X-Rate-Limit-Remaining and X-Rate-Limit-Reset
+    headers (EDSM) refill their limit within the reset time. The bucket mirrors that: it holds the remaining requests
+    and refills at (limit - remaining) / reset requests per second. Hosts without these headers aren't limited.
+    Part of the budget is reserved for important requests, see RESERVE. Requests with priority 0 wait up to MAX_DELAY
+    seconds for the next token, all others are rejected right away.
+    """
+
+    RESERVE = (0.0, 0.25, 0.5)  # fraction of the limit that a request of this priority must leave for more important ones
+    MAX_DELAY = 3  # seconds
+    DEFAULT_WINDOW = 3600  # seconds in which the limit refills if the host didn't tell yet
+
+    def __init__(self, host: str):
+        self.host = host
+        self.__lock = threading.Lock()
+        self.__limit: Optional[int] = None  # None until the host sent rate limit headers
+        self.__tokens = 0.0
+        self.__rate = 0.0  # tokens per second
+        self.__updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.__tokens = min(self.__tokens + (now - self.__updated) * self.__rate, self.__limit)
+        self.__updated = now
+
+    def acquire(self, priority: int = 0):
+        """
+        Take a token, waiting for it if the request is important.
+        :param priority: lower numbers are more important, same values as TaskQueue.PRIORITY_<name>
+        :raises RateLimited: if there is no budget for this request
+        """
+        with self.__lock:
+            if self.__limit is None:
+                return
+            now = time.monotonic()
+            self._refill(now)
+            reserve = self.__limit * TokenBucket.RESERVE[min(max(priority, 0), len(TokenBucket.RESERVE) - 1)]
+            missing = 1 + reserve - self.__tokens
+            if missing > 0:
+                delay = missing / self.__rate if self.__rate > 0 else math.inf
+                if priority > 0 or delay > TokenBucket.MAX_DELAY:
+                    raise RateLimited(f"Rate limit of {self.host} reached, {self.__tokens:.1f} of {self.__limit} requests left.")
+                self.__tokens -= 1  # taken now, so concurrent requests wait for the following tokens
+                self.__updated = now
+            else:
+                self.__tokens -= 1
+                return
+        time.sleep(delay)
+
+    def update(self, response: requests.Response):
+        """
+        Take the remaining budget from the headers of a response.
+        """
+        try:
+            limit = int(response.headers["X-Rate-Limit-Limit"])
+            remaining = int(response.headers["X-Rate-Limit-Remaining"])
+            reset = float(response.headers.get("X-Rate-Limit-Reset", 0))
+        except (KeyError, ValueError):
+            return
+        with self.__lock:
+            if limit <= 0:
+                return
+            self.__limit = limit
+            if response.status_code == 429:
+                remaining = 0
+            if reset > 0 and remaining < limit:
+                self.__rate = (limit - remaining) / reset
+            elif self.__rate == 0:
+                self.__rate = limit / TokenBucket.DEFAULT_WINDOW
+            self.__tokens = float(remaining)
+            self.__updated = time.monotonic()
+
+
+class EndpointHealth(object):
+    """
+    Circuit breaker for one host. After FAILURE_THRESHOLD failed requests in a row the circuit opens and requests fail
+    right away instead of waiting for the timeout. Once the backoff elapsed, a single probe request is let through
+    (half-open). The circuit closes if it succeeds, otherwise the backoff doubles up to MAX_BACKOFF. The backoff is
+    shortened by a random amount, so several hosts don't retry at the same time.
+    """
+
+    FAILURE_THRESHOLD = 2
+    BASE_BACKOFF = 15  # seconds
+    MAX_BACKOFF = 10 * 60  # seconds
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, host: str):
+        self.host = host
+        self.state = EndpointHealth.CLOSED
+        self.__lock = threading.Lock()
+        self.__failures = 0  # failed requests in a row
+        self.__trips = 0  # times the circuit opened without a successful request in between
+        self.__retry_date = 0.0  # monotonic time of the next probe
+        self.__probing = False
+
+    def is_available(self) -> bool:
+        return self.state == EndpointHealth.CLOSED
+
+    def get_retry_delay(self) -> float:
+        """
+        :return: seconds until the next probe request is allowed
+        """
+        return max(self.__retry_date - time.monotonic(), 0.0)
+
+    def allow_request(self) -> bool:
+        with self.__lock:
+            if self.state == EndpointHealth.CLOSED:
+                return True
+            if self.state == EndpointHealth.OPEN and time.monotonic() >= self.__retry_date:
+                self.state = EndpointHealth.HALF_OPEN
+            if self.state == EndpointHealth.HALF_OPEN and not self.__probing:
+                self.__probing = True
+                return True
+            return False
+
+    def record_success(self) -> bool:
+        """
+        :return: True if the host became available
+        """
+        with self.__lock:
+            changed = self.state != EndpointHealth.CLOSED
+            self.state = EndpointHealth.CLOSED
+            self.__failures = 0
+            self.__trips = 0
+            self.__probing = False
+            return changed
+
+    def record_failure(self) -> bool:
+        """
+        :return: True if the host became unavailable
+        """
+        with self.__lock:
+            self.__failures += 1
+            if self.state == EndpointHealth.CLOSED and self.__failures < EndpointHealth.FAILURE_THRESHOLD:
+                return False
+            changed = self.state == EndpointHealth.CLOSED
+            backoff = min(EndpointHealth.BASE_BACKOFF * 2 ** self.__trips, EndpointHealth.MAX_BACKOFF)
+            self.__trips += 1
+            self.__retry_date = time.monotonic() + backoff * random.uniform(0.5, 1.0)
+            self.state = EndpointHealth.OPEN
+            self.__probing = False
+            return changed
+
+
+class HttpClient(object):
+    """
+    One HTTP session for all remote calls of the plugin. Connections to cyberlord.de, edsm.net and api.github.com are
+    kept alive and reused, so only the first call to a host pays for the TCP and TLS handshake.
+    """
+
+    CONNECT_TIMEOUT = 5  # seconds
+    READ_TIMEOUT = 10  # seconds
+    POOL_HOSTS = 4  # number of hosts that keep a connection pool
+    POOL_CONNECTIONS_PER_HOST = 4
+
+    def __init__(self, user_agent: str, connect_timeout: Union[int, float] = CONNECT_TIMEOUT, read_timeout: Union[int, float] = READ_TIMEOUT,
+                 metrics: Optional[MetricsRegistry] = None, tracer: Optional[Tracer] = None):
+        self.metrics = metrics or MetricsRegistry()
+        self.tracer = tracer or Tracer()
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.session = requests.Session()
+        self.session.headers.update({"User-Agent": user_agent, "Accept-Encoding": "gzip, deflate"})
+        adapter = HTTPAdapter(pool_connections=HttpClient.POOL_HOSTS, pool_maxsize=HttpClient.POOL_CONNECTIONS_PER_HOST, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.__executor: Optional[ThreadPoolExecutor] = None  # created on first use of submit
+        self.__health: Dict[str, EndpointHealth] = dict()  # key = host
+        self.__buckets: Dict[str, TokenBucket] = dict()  # key = host
+        self.__health_lock = threading.Lock()
+        self.on_availability_changed: Optional[Callable[[str, bool], None]] = None  # called with host and new availability
+
+    def get_health(self, url: str) -> EndpointHealth:
+        host = urlsplit(url).hostname or ""
+        with self.__health_lock:
+            health = self.__health.get(host)
+            if health is None:
+                health = self.__health[host] = EndpointHealth(host)
+            return health
+
+    def get_bucket(self, url: str) -> TokenBucket:
+        host = urlsplit(url).hostname or ""
+        with self.__health_lock:
+            bucket = self.__buckets.get(host)
+            if bucket is None:
+                bucket = self.__buckets[host] = TokenBucket(host)
+            return bucket
+
+    def get_unavailable_hosts(self) -> List[str]:
+        with self.__health_lock:
+            return sorted(host for host, health in self.__health.items() if not health.is_available())
+
+    def get(self, url: str, stream: bool = False, priority: int = 0, **kwargs) -> requests.Response:
+        """
+        Same as requests.get but uses the shared session and the configured timeouts.
+        Responses with a status code of 500 or above count as failures of the host, see EndpointHealth.
+
+        :param priority: lower numbers are more important, same values as TaskQueue.PRIORITY_<name>, see TokenBucket
+        :raises RateLimited: if the rate limit of the host leaves no room for a request of this priority
+        :raises EndpointUnavailable: if the host failed recently and isn't probed yet
+        """
+        bucket = self.get_bucket(url)
+        health = self.get_health(url)
+        try:
+            bucket.acquire(priority)
+        except RateLimited:
+            self.metrics.increment(f"http.{health.host}.rate_limited")
+            raise
+        if not health.allow_request():
+            self.metrics.increment(f"http.{health.host}.rejected")
+            raise EndpointUnavailable(f"{health.host} is unavailable, next try in {health.get_retry_delay():.0f}s.")
+        kwargs.setdefault("timeout", (self.connect_timeout, self.read_timeout))
+        start = time.perf_counter()
+        try:
+            with self.tracer.span("http", host=health.host, priority=priority) as span:
+                response = self.session.get(url, stream=stream, **kwargs)
+                span["status"] = response.status_code
+        except Exception:  # not only RequestException, a probe must always end with a result
+            self.metrics.increment(f"http.{health.host}.errors")
+            self._record_result(health, False)
+            raise
+        finally:
+            self.metrics.observe(f"http.{health.host}", time.perf_counter() - start)  # until the headers arrived
+        bucket.update(response)
+        self._record_result(health, response.status_code < 500)
+        return response
+
+    def record_failure(self, url: str):
+        """
+        Count a failure of the host that get couldn't see, e.g. reading the body of a streamed response failed.
+        """
+        health = self.get_health(url)
+        self.metrics.increment(f"http.{health.host}.errors")
+        self._record_result(health, False)
+
+    def _record_result(self, health: EndpointHealth, success: bool):
+        changed = health.record_success() if success else health.record_failure()
+        if changed and self.on_availability_changed:
+            self.on_availability_changed(health.host, success)
+
+    def submit(self, url: str, **kwargs) -> Future:
+        """
+        Same as get but runs in the background, so several requests can be sent at once.
+        """
+        if self.__executor is None:
+            self.__executor = ThreadPoolExecutor(max_workers=HttpClient.POOL_CONNECTIONS_PER_HOST, thread_name_prefix="EDSM-RSE HTTP")
+        return self.__executor.submit(self._get_in_trace, self.tracer.get_trace_id(), url, **kwargs)
+
+    def _get_in_trace(self, trace_id: Optional[str], url: str, **kwargs) -> requests.Response:
+        with self.tracer.trace(trace_id):  # the trace of the thread that called submit
+            return self.get(url, **kwargs)
+
+    def close(self):
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
@@ -0,0 +1,128 @@
+"""
+EDSM-RSE a plugin for EDMC
+Copyright (C) 2019 Sebastian Bauer
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import codecs
+import json
+import re
+
+from typing import Any, Iterable, Iterator, Optional
+
+_WHITESPACE = " \t\n\r"
+_DELIMITERS = _WHITESPACE + ",]"
+_decoder = json.JSONDecoder()
+_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\],:]|[^\s{}\[\],:"]+')  # string, structural character or other value
+
+
+def iter_json_array(chunks: Iterable[bytes]) -> Iterator[Any]:
+    """
+    Parse a JSON array that arrives in chunks of UTF-8 encoded bytes and yield its elements one by one.
+    Only the element that is currently parsed is kept in memory, not the whole document.
+
+    :raises ValueError: if the document is not a JSON array or is incomplete
+    """
+    utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+    chunk_iterator = iter(chunks)
+    buffer = ""
+    position = 0
+    finished = False
+    started = False
+
+    def read_more() -> bool:
+        nonlocal buffer, position, finished
+        if finished:
+            return False
+        try:
+            chunk = next(chunk_iterator)
+            text = utf8_decoder.decode(chunk)
+        except StopIteration:
+            text = utf8_decoder.decode(b"", final=True)
+            finished = True
+        buffer = buffer[position:] + text
+        position = 0
+        return True
+
+    def skip_whitespace() -> bool:
+        """ Move position to the next character that is not whitespace. Returns False at the end of the document. """
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in _WHITESPACE:
+                position += 1
+            if position < len(buffer):
+                return True
+            if not read_more():
+                return False
+
+    if not skip_whitespace() or buffer[position] != "[":
+        raise ValueError("Expected a JSON array.")
+    position += 1
+
+    while True:
+        if not skip_whitespace():
+            raise ValueError("Incomplete JSON array.")
+        if buffer[position] == "]":
+            return
+        if started:
+            if buffer[position] != ",":
+                raise ValueError(f"Expected ',' in JSON array, got {buffer[position]!r}.")
+            position += 1
+            if not skip_whitespace():
+                raise ValueError("Incomplete JSON array.")
+        started = True
+
+        while True:
+            try:
+                element, end = _decoder.raw_decode(buffer, position)
+                # a number might continue in the next chunk, only accept it if a delimiter follows
+                if finished or (end < len(buffer) and buffer[end] in _DELIMITERS):
+                    break
+            except json.JSONDecodeError:
+                if finished:
+                    raise
+            if not read_more():
+                raise ValueError("Incomplete JSON array.")
+        position = end
+        yield element
+
+
+def count_json_array(text: str, key: str) -> Optional[int]:
+    """
+    Count the elements of the array that is stored under key in the top level object of a JSON document.
+    The document is only split into tokens, the elements themselves are never parsed.
+
+    :return: number of elements or None if there is no such array
+    """
+    key_token = json.dumps(key)
+    depth = 0
+    array_depth = None  # depth of the elements of the counted array
+    count = 0
+    previous = (None, None)  # last two tokens
+    for match in _TOKEN.finditer(text):
+        token = match.group()
+        if depth == array_depth and token != "," and token != "]":
+            count += 1  # start of an element
+        if token == "{" or token == "[":
+            if array_depth is None and token == "[" and depth == 1 and previous == (key_token, ":"):
+                array_depth = depth + 1
+            depth += 1
+        elif token == "}" or token == "]":
+            depth -= 1
+            if array_depth is not None and depth < array_depth:
+                return count
+        previous = (previous[1], token)
+    return None
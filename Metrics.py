@@ -0,0 +1,149 @@
+"""
+EDSM-RSE a plugin for EDMC
+Copyright (C) 2019 Sebastian Bauer
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+
+class Histogram(object):
+    """
+    Distribution of durations in fixed buckets. Percentiles are reported as the upper bound of their bucket.
+    """
+
+    BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)  # upper bounds of the buckets in ms
+
+    def __init__(self):
+        self.counts: List[int] = [0] * (len(Histogram.BOUNDS) + 1)  # last bucket holds everything above the bounds
+        self.count = 0
+        self.total = 0.0  # ms
+        self.max = 0.0  # ms
+
+    def add(self, milliseconds: float):
+        self.counts[bisect.bisect_left(Histogram.BOUNDS, milliseconds)] += 1
+        self.count += 1
+        self.total += milliseconds
+        self.max = max(self.max, milliseconds)
+
+    def get_percentile(self, fraction: float) -> float:
+        """
+        :return: upper bound in ms of the bucket that contains the percentile or the maximum if it is above all bounds
+        """
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return Histogram.BOUNDS[index] if index < len(Histogram.BOUNDS) else self.max
+        return self.max
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"count": self.count,
+                "avg_ms": round(self.total / self.count, 3) if self.count else 0,
+                "p50_ms": self.get_percentile(0.5),
+                "p95_ms": self.get_percentile(0.95),
+                "max_ms": round(self.max, 3),
+                "buckets": {str(bound): count for bound, count in zip(Histogram.BOUNDS + ("inf",), self.counts) if count}}
+
+    def __str__(self):
+        return (f"n={self.count} avg={self.total / max(self.count, 1):.1f}ms p50<={self.get_percentile(0.5):.0f}ms "
+                f"p95<={self.get_percentile(0.95):.0f}ms max={self.max:.1f}ms")
+
+
+class MetricsRegistry(object):
+    """
+    Counters, gauges and duration histograms of the plugin, e.g. the time tasks wait in the queue and run, the time of
+    remote calls per host and of writes to the local database. Names are dotted, like task_run.JumpedSystemTask.
+    Everything is kept since the start of EDMC and can be written to a JSON file with dump.
+    """
+
+    FILE_NAME = "metrics.json"
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters: Dict[str, int] = dict()
+        self.__gauges: Dict[str, Dict[str, float]] = dict()  # value = {"value": last value, "max": highest value}
+        self.__histograms: Dict[str, Histogram] = dict()
+        self.__start_date = time.time()
+
+    def increment(self, name: str, amount: int = 1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + amount
+
+    def set_gauge(self, name: str, value: Union[int, float]):
+        with self.__lock:
+            gauge = self.__gauges.setdefault(name, {"value": value, "max": value})
+            gauge["value"] = value
+            gauge["max"] = max(gauge["max"], value)
+
+    def observe(self, name: str, seconds: float):
+        with self.__lock:
+            histogram = self.__histograms.get(name)
+            if histogram is None:
+                histogram = self.__histograms[name] = Histogram()
+            histogram.add(seconds * 1000)
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """
+        Observe the duration of the with block, also if it raises an exception.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def get_histogram(self, name: str) -> Optional[Histogram]:
+        return self.__histograms.get(name)
+
+    def get_counter(self, name: str) -> int:
+        return self.__counters.get(name, 0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.__lock:
+            return {"start_date": self.__start_date,
+                    "date": time.time(),
+                    "counters": dict(sorted(self.__counters.items())),
+                    "gauges": {name: dict(gauge) for name, gauge in sorted(self.__gauges.items())},
+                    "histograms": {name: histogram.to_dict() for name, histogram in sorted(self.__histograms.items())}}
+
+    def get_summary(self) -> List[str]:
+        """
+        :return: one line of text per metric
+        """
+        with self.__lock:
+            lines = [f"{name}: {histogram}" for name, histogram in sorted(self.__histograms.items())]
+            lines.extend(f"{name}: {gauge['value']} (max {gauge['max']})" for name, gauge in sorted(self.__gauges.items()))
+            lines.extend(f"{name}: {count}" for name, count in sorted(self.__counters.items()))
+            return lines
+
+    def dump(self, directory: str):
+        """
+        Write the current values to FILE_NAME in directory. The file is replaced at once, so readers never see half of it.
+        """
+        path = os.path.join(directory, MetricsRegistry.FILE_NAME)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, indent=1)
+        os.replace(path + ".tmp", path)
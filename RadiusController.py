@@ -0,0 +1,144 @@
+"""
+EDSM-RSE a plugin for EDMC
+Copyright (C) 2019 Sebastian Bauer
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import math
+import time
+
+from collections import deque
+from typing import Deque, FrozenSet, List, Optional, Union
+
+
+class RadiusDecision(object):
+    """
+    One choice of the RadiusController, kept for tuning the constants.
+    """
+
+    def __init__(self, old_exponent: float, new_exponent: float, density: Optional[float], expected: Optional[float]):
+        self.date = time.time()
+        self.old_exponent = old_exponent
+        self.new_exponent = new_exponent
+        self.density = density  # targets per ly³, None without observations
+        self.expected = expected  # number of targets expected with the new radius
+
+    def __str__(self):
+        if self.density is None:
+            return f"radius exponent {self.old_exponent} -> {self.new_exponent}, no observations"
+        return (f"radius exponent {self.old_exponent} -> {self.new_exponent} ({RadiusController.get_radius(self.new_exponent):.0f} ly), "
+                f"density {self.density:.3g}/ly³, expecting {self.expected:.0f} targets")
+
+
+class RadiusController(object):
+    """
+    Choose the radius for the remote database from an estimate of the number of targets per volume.
+    Every list of targets that is built, remote or from the local spatial index, is an observation of the density. Older
+    observations lose weight with every new one, so the estimate follows the commander through the galaxy.
+    The radius only changes if the expected number of targets leaves the band TARGET_MIN to TARGET_MAX. Then the smallest
+    radius that is expected to return TARGET_COUNT targets is chosen. The exponent is quantized, so similar densities
+    share the same radius and the same query tiles, see SpatialIndex.get_tile_sphere.
+    """
+
+    TARGET_MIN = 20
+    TARGET_MAX = 80
+    TARGET_COUNT = 40  # geometric mean of the band, one step of the exponent changes the volume by less than the band
+    EXPONENT_STEP = 0.25
+    MIN_EXPONENT = 0
+    MAX_EXPONENT = 10
+    HISTORY_WEIGHT = 0.5  # weight of the previous observations when a new one is added
+    PRIOR_COUNT = 0.5  # keeps the density above 0 if no targets were found
+    DISK_HALF_THICKNESS = 1000  # ly above and below the galactic plane that contain targets
+    MAX_DECISIONS = 50
+
+    def __init__(self):
+        self.__count = 0.0  # weighted sum of observed targets
+        self.__volume = 0.0  # weighted sum of observed volumes in ly³
+        self.__flags: Optional[FrozenSet[int]] = None
+        self.__decisions: Deque[RadiusDecision] = deque(maxlen=RadiusController.MAX_DECISIONS)
+
+    @staticmethod
+    def get_radius(exponent: Union[int, float]) -> float:
+        return 39 + 11 * (2 ** exponent)
+
+    @staticmethod
+    def get_volume(y: float, radius: float) -> float:
+        """
+        Volume of the part of a sphere at height y that lies within the galactic disk.
+        """
+        bottom = max(-radius, -RadiusController.DISK_HALF_THICKNESS - y)
+        top = min(radius, RadiusController.DISK_HALF_THICKNESS - y)
+        if top <= bottom:
+            return 0.0
+
+        def integral(t: float) -> float:
+            return radius * radius * t - t ** 3 / 3
+
+        return math.pi * (integral(top) - integral(bottom))
+
+    def reset(self):
+        self.__count = 0.0
+        self.__volume = 0.0
+        self.__flags = None
+
+    def get_density(self) -> Optional[float]:
+        """
+        :return: estimated targets per ly³ or None if nothing was observed yet
+        """
+        if self.__volume <= 0:
+            return None
+        return (self.__count + RadiusController.PRIOR_COUNT) / self.__volume
+
+    def get_decisions(self) -> List[RadiusDecision]:
+        return list(self.__decisions)
+
+    def observe(self, count: int, y: float, radius: float, flags: FrozenSet[int]):
+        """
+        Add the number of targets that were found within radius of a position at height y.
+        Observations for other projects don't describe the same targets and start a new history.
+        """
+        if flags != self.__flags:
+            self.reset()
+            self.__flags = flags
+        volume = self.get_volume(y, radius)
+        if volume <= 0:
+            return
+        self.__count = self.__count * RadiusController.HISTORY_WEIGHT + count
+        self.__volume = self.__volume * RadiusController.HISTORY_WEIGHT + volume
+
+    def choose_exponent(self, exponent: float, y: float) -> float:
+        """
+        :param exponent: current exponent of the radius
+        :param y: height of the position of the next query
+        :return: exponent for the next query
+        """
+        density = self.get_density()
+        if density is None:
+            decision = RadiusDecision(exponent, exponent, None, None)
+        else:
+            expected = density * self.get_volume(y, self.get_radius(exponent))
+            new_exponent = exponent
+            if not RadiusController.TARGET_MIN <= expected <= RadiusController.TARGET_MAX:
+                new_exponent = RadiusController.MIN_EXPONENT
+                while new_exponent < RadiusController.MAX_EXPONENT:
+                    expected = density * self.get_volume(y, self.get_radius(new_exponent))
+                    if expected >= RadiusController.TARGET_COUNT:
+                        break
+                    new_exponent += RadiusController.EXPONENT_STEP
+                expected = density * self.get_volume(y, self.get_radius(new_exponent))
+            decision = RadiusDecision(exponent, new_exponent, density, expected)
+        self.__decisions.append(decision)
+        return decision.new_exponent
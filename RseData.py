@@ -23,12 +23,25 @@ import os
 import time
 import math
 import sqlite3
+import threading
 import json
 import logging
-import requests
+from concurrent.futures import Future
+from contextlib import contextmanager
 from urllib.parse import urlencode
-from config import appname
-from typing import Dict, List, Any, Set, Union, Tuple, KeysView, Optional
+from config import appname, config
+from typing import Dict, List, Any, Set, Union, Tuple, Optional, Iterable, Iterator
+
+from SpatialIndex import SpatialIndex, CoveredSphere, RseRow, row_from_json, ROW_ID64, ROW_X, ROW_Y, ROW_Z, ROW_ACTION
+from DistanceFilter import CoordinateArrays
+from JsonStream import iter_json_array
+from SystemTable import SystemTable
+from RadiusController import RadiusController
+from SystemCache import ExpiringSet, CacheView, PermanentIdSet, LruCache
+from HttpClient import HttpClient, EndpointUnavailable
+from Metrics import MetricsRegistry
+from Tracer import Tracer
+from TaskQueue import TaskQueue
 
 
 logger = logging.getLogger(f"{appname}.{os.path.basename(os.path.dirname(__file__))}")
@@ -52,7 +65,6 @@ class EliteSystem(object):
         self.z = z
         self.uncertainty = uncertainty
         self.distance = 10000  # set initial value to be out of reach
-        self.__rseProjects: Dict[int, RseProject] = dict()
 
     @staticmethod
     def calculate_distance(x1: Union[int, float], x2: Union[int, float], y1: Union[int, float], y2: Union[int, float], z1: Union[int, float], z2: Union[int, float]):
@@ -67,23 +79,6 @@ class EliteSystem(object):
     def calculate_distance_to_coordinates(self, x: Union[int, float], y: Union[int, float], z: Union[int, float]) -> float:
         return self.calculate_distance(self.x, x, self.y, y, self.z, z)
 
-    def remove_from_project(self, project_id: int):
-        if project_id in self.__rseProjects:
-            del self.__rseProjects[project_id]
-
-    def remove_from_all_projects(self):
-        self.__rseProjects.clear()
-
-    def add_to_project(self, rse_project: RseProject):
-        self.__rseProjects.setdefault(rse_project.project_id, rse_project)
-
-    def add_to_projects(self, rse_projects: List[RseProject]):
-        for rse_project in rse_projects:
-            self.add_to_project(rse_project)
-
-    def get_project_ids(self) -> KeysView[int]:
-        return self.__rseProjects.keys()
-
     def calculate_distance_to_system(self, system2) -> float:
         """
         Calculate distance to other EliteSystem
@@ -92,12 +87,6 @@ class EliteSystem(object):
         """
         return self.calculate_distance_to_coordinates(system2.x, system2.y, system2.z)
 
-    def get_action_text(self) -> str:
-        if len(self.__rseProjects) > 0:
-            return ", ".join([rse_project.action_text for rse_project in self.__rseProjects.values()])
-        else:
-            return ""
-
     def __str__(self):
         return "id64: {id64}, name: {name}, distance: {distance:,.2f}, uncertainty: {uncertainty}"\
             .format(id64=self.id64, name=self.name, distance=self.distance, uncertainty=self.uncertainty)
@@ -125,11 +114,28 @@ class RseData(object):
 
     # settings for search radius
     DEFAULT_RADIUS_EXPONENT = 5  # key for radius, see calculateRadius
-    MAX_RADIUS = 10
-    RADIUS_ADJUSTMENT_INCREASE = 15  # increase radius if at most this amount of systems were found
-    RADIUS_ADJUSTMENT_DECREASE = 100  # decrease the radius if at least this amount of systems were found
 
-    EDSM_NUMBER_OF_SYSTEMS_TO_QUERY = 15
+    EDSM_NUMBER_OF_SYSTEMS_TO_QUERY = 15  # per request
+    EDSM_MAX_REQUESTS = 3  # requests to check the closest systems
+    # seconds to wait for the first request before the others are sent at once. if the first one answers sooner without
+    # a target, the others follow right away, so the closest target costs two round-trips instead of one
+    EDSM_SPECULATIVE_DELAY = 0.5
+    EDSM_MAX_URL_LENGTH = 2000
+    PREFETCH_HOPS = 2  # number of upcoming jumps of the plotted route to prefetch targets for
+    BODY_COUNT_TTL = 10 * 60  # seconds a body count from EDSM is kept
+    BODY_COUNT_CACHE_SIZE = 64  # number of systems with a body count from EDSM
+    PROJECTS_URL = "https://cyberlord.de/rse/projects.py"
+    PROJECTS_TTL = 24 * 3600  # refresh the locally stored projects after this many seconds
+    DB_CACHED_STATEMENTS = 32
+    DB_LOAD_CHUNK_SIZE = 2000  # rows read from the local database at once while loading in the background
+
+    # buffered writes to the local database are flushed when one of these limits is reached
+    WRITE_BEHIND_MAX_SYSTEMS = 50
+    WRITE_BEHIND_MAX_RSE_ROWS = 5000
+    WRITE_BEHIND_MAX_DELAY = 60  # seconds
+    MAX_SYSTEMS_IN_LIST = 500  # only the closest systems are kept as targets
+    STREAM_CHUNK_SIZE = 64 * 1024  # bytes read at once from responses of the RSE API
+    FETCH_FAILED = object()  # returned by fetch_tile_around if the remote database couldn't be reached
 
     # Values for projects
     PROJECT_RSE = 1
@@ -141,29 +147,47 @@ class RseData(object):
     BG_RSE_MESSAGE = "bg_rse_message"  # RSE message as string
     BG_UPDATE_JSON = "bg_update_json"  # information about available update
     BG_EDSM_BODY = "bg_edsm_body"  # EDSM body count information as string
+    BG_UNAVAILABLE_HOSTS = "bg_unavailable_hosts"  # list of hosts that failed recently
+    BG_TRACE_ID = "bg_trace_id"  # trace of the task that fired the last event, see Tracer
 
     # name of events
     EVENT_RSE_UPDATE_AVAILABLE = "<<EDSM-RSE_UpdateAvailable>>"
     EVENT_RSE_BACKGROUNDWORKER = "<<EDSM-RSE_BackgroundWorker>>"
     EVENT_RSE_EDSM_BODY_COUNT = "<<EDSM-RSE_EdsmBodyCount>>"
+    EVENT_RSE_CONNECTION = "<<EDSM-RSE_Connection>>"
 
     # possible caches
     CACHE_IGNORED_SYSTEMS = 1
     CACHE_FULLY_SCANNED_BODIES = 2
-    CACHE_EDSM_RSE_QUERY = 3
+    CACHE_EDSM_RSE_QUERY = 3  # systems that EDSM reported without coordinates, short lived
+    CACHE_COORDINATES_CONFIRMED = 4  # systems that EDSM reported with coordinates
+
+    # caches that never expire and are stored in a sorted file, value = file name without extension
+    PERMANENT_CACHES = {CACHE_FULLY_SCANNED_BODIES: "fully_scanned", CACHE_COORDINATES_CONFIRMED: "coordinates_confirmed"}
 
     def __init__(self, plugin_dir: str, radius_exponent: int = DEFAULT_RADIUS_EXPONENT):
         self.plugin_dir = plugin_dir
         self.new_version_info = None
-        self.system_list: List[EliteSystem] = list()  # nearby systems, sorted by distance
+        self.system_list = SystemTable()  # nearby systems, sorted by distance. assign a new table instead of clearing it
+        self.current_system: Optional[EliteSystem] = None  # position of the last JumpedSystemTask
         self.projects_dict: Dict[int, RseProject] = dict()  # key = ID
         self.frame = None
         self.last_event_info: Dict[str, Any] = dict()  # used to pass values to UI. don't assign a new value! use clear() instead
         self.radius_exponent: int = radius_exponent
+        self.radius_controller = RadiusController()  # chooses radius_exponent, see adjust_radius_exponent
         self.frame: Union[tkinter.Frame, None] = None
         self.local_db_cursor = None
         self.local_db_connection = None
         self.ignored_projects_flags: int = 0  # bit mask of ignored projects (AND of all their IDs)
+        self.spatial_index = SpatialIndex()  # every system received from the remote database
+        self.metrics = MetricsRegistry()  # timings of tasks, remote calls and the local database, see BackgroundWorker.dump_metrics
+        self.tracer = Tracer()  # disabled unless turned on in the settings
+        self.http = HttpClient(f"{RseData.PLUGIN_NAME}/{RseData.VERSION}", metrics=self.metrics, tracer=self.tracer)  # shared by all remote calls
+        self.http.on_availability_changed = self.on_host_availability_changed
+        self.background_queue: Optional[TaskQueue] = None  # queue of the background worker, set by BackgroundWorker
+        self.body_counts = LruCache(RseData.BODY_COUNT_CACHE_SIZE, RseData.BODY_COUNT_TTL)  # key = ID64, value = number of bodies known to EDSM
+        self.body_count_requests: Dict[int, Future] = dict()  # key = ID64, running body count requests, see EdsmBodyCheck
+        self.body_count_lock = threading.Lock()  # guards body_count_requests, fetches run on several threads
 
         """ 
         Dictionary of sets that contain the cached systems. 
@@ -171,9 +195,21 @@ class RseData(object):
         corresponding systems 
         Key for set is the ID64 of the cached system
         """
-        self.__cachedSystems: Dict[int, Set[int]] = dict()
-
-    def get_cached_set(self, cache_type: int) -> Set[int]:
+        self.__cachedSystems: Dict[int, Union[ExpiringSet, PermanentIdSet]] = dict()
+        for cache_type, name in RseData.PERMANENT_CACHES.items():
+            self.__cachedSystems[cache_type] = PermanentIdSet(plugin_dir, name)
+        self.__transaction_depth = 0
+
+        # changes that are not written to the local database yet, see flush_pending_writes
+        self.__pending_cache_writes: Dict[Tuple[int, int], int] = dict()  # key = (ID64, cache type), value = expiration time
+        self.__pending_cache_clears: Set[int] = set()  # cache types
+        self.__pending_rse_rows: Dict[int, Tuple] = dict()  # key = ID64, value = row for table RseSystems
+        self.__pending_rse_removals: Set[int] = set()  # ID64
+        self.__pending_coverage: List[CoveredSphere] = list()
+        self.__pending_since: Optional[float] = None
+        self.__loader: Optional[Iterator[None]] = None  # loads local data in chunks, see load_next_chunk
+
+    def get_cached_set(self, cache_type: int) -> Union[ExpiringSet, PermanentIdSet]:
         """
         Return set of cached systems or empty set.
         :param cache_type: int
@@ -182,14 +218,29 @@ class RseData(object):
         if cache_type in self.__cachedSystems:
             return self.__cachedSystems.get(cache_type)
         else:
-            return self.__cachedSystems.setdefault(cache_type, set())
+            return self.__cachedSystems.setdefault(cache_type, ExpiringSet())
+
+    def get_cached_view(self, *cache_types: int) -> CacheView:
+        """
+        Return a read-only view of the union of several caches without copying them.
+        """
+        return CacheView(*[self.get_cached_set(cache_type) for cache_type in cache_types])
 
     def set_frame(self, frame: tkinter.Frame):
         self.frame = frame
 
     def open_local_database(self):
+        """
+        Open the connection to the local cache. The connection is kept open until close_local_database is called and
+        must only be used by the thread that opened it (the background worker).
+        """
+        if self.is_local_database_accessible():
+            return  # already open
         try:
-            self.local_db_connection = sqlite3.connect(os.path.join(self.plugin_dir, "cache.sqlite"), timeout=10)
+            self.local_db_connection = sqlite3.connect(os.path.join(self.plugin_dir, "cache.sqlite"), timeout=10,
+                                                       cached_statements=RseData.DB_CACHED_STATEMENTS)
+            self.local_db_connection.execute("PRAGMA journal_mode=WAL")
+            self.local_db_connection.execute("PRAGMA synchronous=NORMAL")  # WAL is still consistent after a crash, only fsync on checkpoints
             self.local_db_cursor = self.local_db_connection.cursor()
         except Exception as e:
             error_message = "Local cache database could not be opened"
@@ -206,43 +257,54 @@ class RseData(object):
     def is_local_database_accessible(self):
         return hasattr(self, "local_db_cursor") and self.local_db_cursor
 
-    def adjust_radius_exponent(self):
+    @contextmanager
+    def transaction(self):
         """
-        Adjust the radius to ensure that not too many systems are found (decrease network traffic and database load)
+        Group all writes into a single commit. Nested transactions are part of the outermost one.
         """
+        self.__transaction_depth += 1
+        try:
+            yield
+        except Exception:
+            self.__transaction_depth -= 1
+            if self.__transaction_depth == 0 and self.is_local_database_accessible():
+                self.local_db_connection.rollback()
+            raise
+        self.__transaction_depth -= 1
+        self._commit()
+
+    def _commit(self):
+        if self.__transaction_depth == 0 and self.is_local_database_accessible():
+            self.local_db_connection.commit()
 
-        def inverse_calculate_radius(d: int) -> float:
-            if d > 50:
-                return math.log((d - 39) / 11, 2)
-            else:
-                return 0
-
-        number_of_systems = len(self.system_list)
-
-        # not enough systems in range
-        if number_of_systems <= RseData.RADIUS_ADJUSTMENT_INCREASE:
-            self.radius_exponent = int(self.radius_exponent) + 1
-            if self.radius_exponent > RseData.MAX_RADIUS:
-                self.radius_exponent = 10
-            logger.debug(f"Found too few systems, increasing radius to {self.calculate_radius()}.")
-
-        # too many systems in range
-        elif number_of_systems >= RseData.RADIUS_ADJUSTMENT_DECREASE:
-            self.radius_exponent = inverse_calculate_radius(self.system_list[RseData.RADIUS_ADJUSTMENT_DECREASE - 1].distance)
-            if self.radius_exponent > RseData.MAX_RADIUS:  # prevent large radius after calculating on cached systems after switching a commander
-                self.radius_exponent = 10
-            logger.debug(f"Found too many systems, decreasing radius to {self.calculate_radius()}.")
-
-        # number of systems within limits but distance exceeds set radius when using cached list -> increase radius
-        elif number_of_systems > 0 and self.calculate_radius() < self.system_list[0].distance:
-            self.radius_exponent = inverse_calculate_radius(self.system_list[0].distance)
-            if self.radius_exponent > RseData.MAX_RADIUS:  # prevent large radius after calculating on cached systems
-                self.radius_exponent = 10
+    def on_host_availability_changed(self, host: str, available: bool):
+        """
+        Called by the HTTP client from any thread when a host fails repeatedly or answers again.
+        Targets come from the local data while the RSE API is unavailable.
+        """
+        if available:
+            logger.info(f"{host} is available again.")
+        else:
+            logger.warning(f"{host} is unavailable, using local data until it answers again.")
+        self.last_event_info[RseData.BG_UNAVAILABLE_HOSTS] = self.http.get_unavailable_hosts()
+        if self.frame and not config.shutting_down:
+            self.frame.event_generate(RseData.EVENT_RSE_CONNECTION, when="tail")  # calls update_ui_connection in main thread
+
+    def adjust_radius_exponent(self):
+        """
+        Choose the radius for the next query from the targets found so far, see RadiusController.
+        Decreases network traffic and database load in dense regions and avoids growing the radius jump by jump in sparse ones.
+        """
+        y = self.current_system.y if self.current_system else 0
+        old_radius = self.calculate_radius()
+        self.radius_exponent = self.radius_controller.choose_exponent(self.radius_exponent, y)
+        if self.calculate_radius() != old_radius:
+            logger.debug(f"Changed {self.radius_controller.get_decisions()[-1]}.")
 
     def calculate_radius(self, exponent: int = 0) -> float:
         if not exponent:
             exponent = self.radius_exponent
-        return 39 + 11 * (2 ** exponent)
+        return RadiusController.get_radius(exponent)
 
     def generate_ignored_actions_list(self) -> Set[int]:
         """
@@ -270,151 +332,542 @@ class RseData(object):
         :return: parsed JSON or None
         """
         try:
-            response = requests.get(rse_url, timeout=10)
+            response = self.http.get(rse_url)
             if response.status_code != 200:
                 # some error occurred
                 logger.debug(f"Error calling RSE API. HTTP code: {response.status_code}.")
                 logger.debug(f"Tried to call {rse_url}.")
                 return None
             return json.loads(response.text)
+        except EndpointUnavailable as e:
+            logger.debug(f"Skipped call of RSE API: {e}")
+            return None
         except Exception as e:
             # some error occurred
             logger.debug("Error calling RSE API.", exc_info=e)
             logger.debug(f"Tried to call {rse_url}.")
             return None
 
-    def generate_lists_from_remote_database(self, cmdr_x: Union[float, int], cmdr_y: Union[float, int], cmdr_z: Union[float, int]) -> bool:
+    def _query_rse_api_rows(self, rse_url: str, x: Union[float, int], y: Union[float, int], z: Union[float, int], radius: float) -> Optional[List[RseRow]]:
         """
-        Takes coordinates of commander and queries the server for systems that are in range. It takes the current set radius and sets any newly found
-        systems to self.systemList. Returns True if new systems were found and False if no new systems were found.
+        Internal method which calls the API for systems and returns all rows within radius or None.
+        The response is parsed while it arrives and every row is reduced to an RseRow right away, so neither the text
+        of the response nor the parsed JSON objects are held in memory at once.
+        """
+        response = None
+        try:
+            with self.tracer.span("rse_api", radius=radius) as span, self.http.get(rse_url, stream=True) as response:
+                if response.status_code != 200:
+                    # some error occurred
+                    logger.debug(f"Error calling RSE API. HTTP code: {response.status_code}.")
+                    logger.debug(f"Tried to call {rse_url}.")
+                    return None
+                squared_radius = radius * radius
+                rows = list()
+                chunks = response.iter_content(chunk_size=RseData.STREAM_CHUNK_SIZE)
+                if self.tracer.enabled:
+                    chunks = self._count_bytes(chunks, span)
+                for _row in iter_json_array(chunks):
+                    row = row_from_json(_row)
+                    if (row[ROW_X] - x) ** 2 + (row[ROW_Y] - y) ** 2 + (row[ROW_Z] - z) ** 2 <= squared_radius:
+                        rows.append(row)
+                span["rows"] = len(rows)
+                return rows
+        except EndpointUnavailable as e:
+            logger.debug(f"Skipped call of RSE API: {e}")
+            return None
+        except Exception as e:
+            # some error occurred
+            logger.debug("Error calling RSE API.", exc_info=e)
+            logger.debug(f"Tried to call {rse_url}.")
+            if response is not None:
+                self.http.record_failure(rse_url)  # reading the body failed, get only saw the status code
+            return None
 
-        :param cmdr_x: x coordinate of current position
-        :param cmdr_y: y coordinate of current position
-        :param cmdr_z: z coordinate of current position
-        :return: True when new systems were found and False if not
+    @staticmethod
+    def _count_bytes(chunks: Iterable[bytes], span) -> Iterator[bytes]:
+        """ Pass the chunks on and store their total size in the bytes attribute of the span. """
+        span["bytes"] = 0
+        total = 0
+        for chunk in chunks:
+            total += len(chunk)
+            span["bytes"] = total
+            yield chunk
+
+    def get_rows_in_sphere(self, x: Union[float, int], y: Union[float, int], z: Union[float, int], radius: float, flags: List[int], remote: bool = True) -> Optional[List[RseRow]]:
+        """
+        Return all systems within the sphere that match the flags. The local spatial index is used when it covers the
+        sphere with fresh data. Otherwise the remote database is queried for the tile that contains the position (see
+        SpatialIndex.get_tile_sphere) and the result is added to the index.
+
+        :param remote: False to only use the local spatial index, e.g. because a fetch just failed
+        :return: list of rows or None if the remote database couldn't be reached
+        """
+        flags_set = frozenset(flags)
+        if self.spatial_index.covers(x, y, z, radius, flags_set, time.time()):
+            with self.metrics.timer("filter.spatial_index"):
+                rows = self.spatial_index.query(x, y, z, radius, flags_set)
+            logger.debug(f"Answered query with {len(rows)} systems from local index.")
+            return rows
+        if not remote:
+            return None
+
+        tile = self.fetch_tile(x, y, z, radius, flags)
+        if tile is None:
+            return None
+        self.store_tile(*tile)
+        return self.spatial_index.query(x, y, z, radius, flags_set)
+
+    def fetch_tile(self, x: Union[float, int], y: Union[float, int], z: Union[float, int], radius: float, flags: List[int]) -> Optional[Tuple[CoveredSphere, List[RseRow]]]:
+        """
+        Query the remote database for the tile that contains the position. Nothing is changed, so this can be called
+        from any thread. The result has to be passed to store_tile by the background worker.
+
+        :return: covered sphere and its rows or None if the remote database couldn't be reached
+        """
+        now = time.time()
+        tile_x, tile_y, tile_z, tile_radius = SpatialIndex.get_tile_sphere(x, y, z, radius)
+        params = {"x": tile_x, "y": tile_y, "z": tile_z,
+                  "radius": tile_radius,
+                  "flags": flags}
+        rse_url = "https://cyberlord.de/rse/systems.py?" + urlencode(params)
+
+        tile_rows = self._query_rse_api_rows(rse_url, tile_x, tile_y, tile_z, tile_radius)  # use an extra method for unit testing purposes
+        if tile_rows is None:
+            return None
+        return CoveredSphere(tile_x, tile_y, tile_z, tile_radius, frozenset(flags), now), tile_rows
+
+    def store_tile(self, covered_sphere: CoveredSphere, rows: List[RseRow]):
+        removed = self.spatial_index.replace_sphere(covered_sphere, rows)
+        self.save_spatial_index_changes(rows, removed, covered_sphere)
+
+    def fetch_tile_around(self, x: Union[float, int], y: Union[float, int], z: Union[float, int]) -> Union[Tuple[CoveredSphere, List[RseRow]], None, object]:
+        """
+        Network part of get_systems_around. Like fetch_tile this can be called from any thread.
+
+        :return: covered sphere and its rows, None if the local index covers the position or all projects are disabled
+                 and FETCH_FAILED if the remote database couldn't be reached
+        """
+        query = self.get_query_parameters()
+        if query is None:
+            return None
+        radius, flags = query
+        if self.spatial_index.covers(x, y, z, radius, frozenset(flags), time.time()):
+            return None
+        tile = self.fetch_tile(x, y, z, radius, flags)
+        return RseData.FETCH_FAILED if tile is None else tile
+
+    def get_query_parameters(self) -> Optional[Tuple[float, List[int]]]:
+        """
+        :return: current radius and flags for the remote database or None if all projects are disabled
         """
         enabled_flags = self.generate_ignored_actions_list()
         if len(enabled_flags) == 0:
-            return False
+            return None
 
         if len(enabled_flags) == 2 ** len(self.projects_dict.values()) - 1:  # all projects are enabled, no need to specify any
             flags = list()
         else:
             flags = list(enabled_flags)
+        return self.calculate_radius(), flags
 
-        params = {"x": cmdr_x, "y": cmdr_y, "z": cmdr_z,
-                  "radius": self.calculate_radius(),
-                  "flags": flags}
-        rse_url = "https://cyberlord.de/rse/systems.py?" + urlencode(params)
-
-        rse_json = self._query_rse_api(rse_url)  # use an extra method for unit testing purposes
-        if not rse_json:
-            return False
-
-        systems: List[EliteSystem] = list()
-        scanned_systems = self.get_cached_set(RseData.CACHE_FULLY_SCANNED_BODIES)
+    def generate_lists_from_remote_database(self, cmdr_x: Union[float, int], cmdr_y: Union[float, int], cmdr_z: Union[float, int], remote: bool = True) -> bool:
+        """
+        Takes coordinates of commander and queries the server for systems that are in range. It takes the current set radius and sets any newly found
+        systems to self.systemList. Returns True if new systems were found and False if no new systems were found.
 
-        for _row in rse_json:
-            rse_id64 = _row["id"]
-            rse_name = _row["name"]
-            rse_x = _row["x"]
-            rse_y = _row["y"]
-            rse_z = _row["z"]
-            uncertainty = _row["uncertainty"]
-            action = _row["action_todo"]
-
-            distance = EliteSystem.calculate_distance(cmdr_x, rse_x, cmdr_y, rse_y, cmdr_z, rse_z)
-            if distance <= self.calculate_radius():
-                elite_system = EliteSystem(rse_id64, rse_name, rse_x, rse_y, rse_z, uncertainty)
-                elite_system.add_to_projects([rseProject for rseProject in self.projects_dict.values() if action & rseProject.project_id])
-                elite_system.distance = distance
-
-                # special case: project 4 (scan bodies)
-                if RseData.PROJECT_SCAN in elite_system.get_project_ids() and elite_system.id64 in scanned_systems:
-                    elite_system.remove_from_project(RseData.PROJECT_SCAN)
-
-                if len(elite_system.get_project_ids()) > 0:
-                    systems.append(elite_system)
-
-        if len(systems) == 0:
+        :param cmdr_x: x coordinate of current position
+        :param cmdr_y: y coordinate of current position
+        :param cmdr_z: z coordinate of current position
+        :param remote: False to only use the local spatial index
+        :return: True when new systems were found and False if not
+        """
+        with self.tracer.span("generate_lists", radius=self.calculate_radius()) as span:
+            systems = self.get_systems_around(cmdr_x, cmdr_y, cmdr_z, remote)
+            span["rows"] = len(systems) if systems is not None else 0
+        if systems is None:
             return False  # nothing new
 
-        # filter out systems that have been completed or are ignored
-        systems = list(filter(lambda system: system.id64 not in self.get_cached_set(RseData.CACHE_IGNORED_SYSTEMS), systems))
-        systems.sort(key=lambda l: l.distance)
-
         self.system_list = systems
         logger.debug("Found {systems} systems within {radius} ly.".format(systems=len(systems), radius=self.calculate_radius()))
 
         return True
 
-    def remove_expired_systems_from_caches(self, handle_db_connection: bool = True):
-        if handle_db_connection:
-            self.open_local_database()
+    def get_systems_around(self, x: Union[float, int], y: Union[float, int], z: Union[float, int], remote: bool = True) -> Optional[SystemTable]:
+        """
+        Build a table of the closest targets within the current radius without changing self.system_list.
+
+        :param remote: False to only use the local spatial index
+
+        :return: table of systems or None if no system of an enabled project is in range
+        """
+        query = self.get_query_parameters()
+        if query is None:
+            return None
+
+        radius, flags = query
+        rows = self.get_rows_in_sphere(x, y, z, radius, flags, remote)
+        if rows is None:
+            return None  # remote database not reachable
+        systems, radius = self.filter_rows(rows, x, y, z, radius)
+        self.radius_controller.observe(len(systems) if systems else 0, y, radius, frozenset(flags))
+        return systems
+
+    def filter_rows(self, rows: List[RseRow], x: Union[float, int], y: Union[float, int], z: Union[float, int], radius: float) -> Tuple[Optional[SystemTable], float]:
+        """
+        Build a table of the closest targets within radius from rows of the spatial index or of a fetched tile. Only
+        reads rse_data, so this can be called from any thread.
+
+        :return: table of systems or None if no system of an enabled project is in range and the radius of the table,
+                 which is smaller than the given one if the table is full
+        """
+        if len(rows) == 0:
+            return None, radius
+
+        filter_start = time.perf_counter()
+        systems = SystemTable()
+        scanned_systems = self.get_cached_set(RseData.CACHE_FULLY_SCANNED_BODIES)
+        confirmed_systems = self.get_cached_set(RseData.CACHE_COORDINATES_CONFIRMED)
+        ignored_systems = self.get_cached_set(RseData.CACHE_IGNORED_SYSTEMS)
+        projects_mask = sum(self.projects_dict.keys())
+        found_systems = False
+
+        # filter by distance on all rows at once and only keep the closest systems
+        coordinates = CoordinateArrays((row[ROW_X], row[ROW_Y], row[ROW_Z], row[ROW_ACTION]) for row in rows)
+        for index, distance in coordinates.nearest(x, y, z, radius, projects_mask):
+            rse_id64, rse_name, rse_x, rse_y, rse_z, uncertainty, action = rows[index]
+
+            # special case: project 4 (scan bodies)
+            if action & RseData.PROJECT_SCAN and rse_id64 in scanned_systems:
+                action = action & ~RseData.PROJECT_SCAN
+                if not action & projects_mask:
+                    continue
+            # special case: project 1 (RSE) but EDSM already knows the coordinates
+            if action & RseData.PROJECT_RSE and rse_id64 in confirmed_systems:
+                action = action & ~RseData.PROJECT_RSE
+                if not action & projects_mask:
+                    continue
+            found_systems = True
+
+            # filter out systems that have been completed or are ignored
+            if rse_id64 in ignored_systems:
+                continue
+
+            systems.append(rse_id64, rse_name, rse_x, rse_y, rse_z, uncertainty, distance, action & projects_mask)
+            if len(systems) >= RseData.MAX_SYSTEMS_IN_LIST:
+                radius = distance  # there might be more systems within the original radius
+                break
+
+        self.metrics.observe("filter.systems_around", time.perf_counter() - filter_start)
+        if not found_systems:
+            return None, radius
+        return systems, radius
+
+    def remove_expired_systems_from_caches(self):
         if not self.is_local_database_accessible():
             return  # can't do anything here
 
         now = time.time()
-        self.local_db_cursor.execute("SELECT id64, cacheType FROM CachedSystems WHERE expirationDate <= ?", (now,))
-        for row in self.local_db_cursor.fetchall():
-            id64, cacheType = row
-            cache = self.get_cached_set(cacheType)
-            if id64 in cache:
-                cache.remove(id64)
-        self.local_db_cursor.execute("DELETE FROM CachedSystems WHERE expirationDate <= ?", (now,))
-        self.local_db_connection.commit()
-
-        if handle_db_connection:
-            self.close_local_database()
-
-    def remove_all_systems_from_cache(self, cache_type: int, handle_db_connection: bool = True):
-        if handle_db_connection:
-            self.open_local_database()
+        for cache in self.__cachedSystems.values():
+            cache.remove_expired(now)
+        for key in [key for key, expiration_time in self.__pending_cache_writes.items() if expiration_time <= now]:
+            del self.__pending_cache_writes[key]  # buffered systems might be expired already
+        self.local_db_cursor.execute("DELETE FROM CachedSystems WHERE expirationDate <= ?", (now,))  # uses index CachedSystemsExpiration
+        self._commit()
+
+        if not self.is_loading():
+            self.merge_permanent_caches()
+
+    def merge_permanent_caches(self):
+        """
+        Move the systems of permanent caches from the local database into their sorted files.
+        """
+        for cache_type in RseData.PERMANENT_CACHES:
+            cache = self.get_cached_set(cache_type)
+            if cache.get_delta_size() == 0:
+                continue
+            logger.debug(f"Merging {cache.get_delta_size()} systems into {cache.name}.")
+            merged = cache.merge()
+            for id64 in merged:
+                self.__pending_cache_writes.pop((id64, cache_type), None)  # the file holds them already
+            # the file is complete at this point. if deleting the rows fails, they are merged again next time
+            self.local_db_cursor.executemany("DELETE FROM CachedSystems WHERE id64 = ? AND cacheType = ?", [(id64, cache_type) for id64 in merged])
+            self._commit()
+
+    def remove_all_systems_from_cache(self, cache_type: int):
+        self.get_cached_set(cache_type).clear()
+        for key in [key for key in self.__pending_cache_writes.keys() if key[1] == cache_type]:
+            del self.__pending_cache_writes[key]
+        self.__pending_cache_clears.add(cache_type)
+        self._mark_pending_writes()
+
+    def add_system_to_cache(self, id64: int, expiration_time: int, cache_type: int):
+        self.add_systems_to_cache([id64], expiration_time, cache_type)
+
+    def add_systems_to_cache(self, id64s: Iterable[int], expiration_time: int, cache_type: int):
+        """
+        Buffer the systems until the next flush_pending_writes. Writing the same ID64 to the same cache again replaces
+        the buffered value.
+        """
+        for id64 in id64s:
+            self.__pending_cache_writes[(id64, cache_type)] = expiration_time
+        self._mark_pending_writes()
+
+    def save_spatial_index_changes(self, rows: List[RseRow], removed: List[int], covered_sphere: CoveredSphere):
+        """
+        Buffer the result of a remote query until the next flush_pending_writes.
+        """
+        for id64 in removed:
+            self.__pending_rse_rows.pop(id64, None)
+            self.__pending_rse_removals.add(id64)
+        for row in rows:
+            self.__pending_rse_removals.discard(row[ROW_ID64])
+            self.__pending_rse_rows[row[ROW_ID64]] = row + (covered_sphere.query_date,)
+        self.__pending_coverage.append(covered_sphere)
+        self._mark_pending_writes()
+
+    def _mark_pending_writes(self):
+        if self.__pending_since is None:
+            self.__pending_since = time.time()
+
+    def has_pending_writes(self) -> bool:
+        return self.__pending_since is not None
+
+    def flush_pending_writes_if_due(self):
+        if not self.has_pending_writes():
+            return
+        if len(self.__pending_cache_writes) >= RseData.WRITE_BEHIND_MAX_SYSTEMS \
+                or len(self.__pending_rse_rows) >= RseData.WRITE_BEHIND_MAX_RSE_ROWS \
+                or time.time() - self.__pending_since >= RseData.WRITE_BEHIND_MAX_DELAY:
+            self.flush_pending_writes()
+
+    def flush_pending_writes(self):
+        """
+        Write all buffered changes to the local database in a single transaction.
+        Does nothing within another transaction: the buffers are cleared right away, so a rollback of the outer
+        transaction would lose the changes. The background worker flushes between tasks.
+        """
+        if not self.has_pending_writes() or not self.is_local_database_accessible() or self.__transaction_depth > 0:
+            return
+
+        with self.tracer.span("sqlite_flush", cached_systems=len(self.__pending_cache_writes), rse_systems=len(self.__pending_rse_rows)), \
+                self.metrics.timer("sqlite.flush"), self.transaction():
+            for cache_type in self.__pending_cache_clears:
+                self.local_db_cursor.execute("DELETE FROM CachedSystems WHERE id64 NOT NULL AND cacheType = ?", (cache_type,))
+            self.local_db_cursor.executemany("INSERT OR REPLACE INTO CachedSystems VALUES (?, ?, ?)",
+                                             [(id64, expiration_time, cache_type) for (id64, cache_type), expiration_time in self.__pending_cache_writes.items()])
+
+            self.local_db_cursor.executemany("DELETE FROM RseSystems WHERE id64 = ?", [(id64,) for id64 in self.__pending_rse_removals])
+            self.local_db_cursor.executemany("INSERT OR REPLACE INTO RseSystems VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self.__pending_rse_rows.values())
+            if len(self.__pending_coverage) > 0:
+                self.local_db_cursor.execute("DELETE FROM RseCoverage WHERE queryDate <= ?", (time.time() - SpatialIndex.COVERAGE_TTL,))
+                self.local_db_cursor.executemany("INSERT INTO RseCoverage VALUES (?, ?, ?, ?, ?, ?)",
+                                                 [(c.x, c.y, c.z, c.radius, c.flags_to_text(), c.query_date) for c in self.__pending_coverage])
+
+        logger.debug(f"Wrote {len(self.__pending_cache_writes)} cached systems and {len(self.__pending_rse_rows)} RSE systems to the local database.")
+        self.__pending_cache_clears.clear()
+        self.__pending_cache_writes.clear()
+        self.__pending_rse_removals.clear()
+        self.__pending_rse_rows.clear()
+        self.__pending_coverage.clear()
+        self.__pending_since = None
+
+    def _load_local_data(self) -> Iterator[None]:
+        """
+        Load the spatial index and the permanent caches in chunks. Every step yields so the background
+        worker can handle tasks in between, see load_next_chunk. The coverage of the index is loaded last, until then
+        all queries go to the remote database.
+        """
         if not self.is_local_database_accessible():
             return  # no database connection
 
-        self.local_db_cursor.execute("DELETE FROM CachedSystems WHERE id64 NOT NULL AND cacheType = ?", (cache_type,))
-        self.local_db_connection.commit()
-
-        if handle_db_connection:
-            self.close_local_database()
+        now = time.time()
+        self.local_db_cursor.execute("DELETE FROM RseSystems WHERE lastSeen <= ?", (now - SpatialIndex.MAX_ROW_AGE,))
+        self.local_db_cursor.execute("DELETE FROM RseCoverage WHERE queryDate <= ?", (now - SpatialIndex.COVERAGE_TTL,))
+        self._commit()
+        yield
+
+        # systems of permanent caches that were not merged into their files yet
+        for cache_type in RseData.PERMANENT_CACHES:
+            cache = self.get_cached_set(cache_type)
+            last_row_id = -1
+            while True:
+                self.local_db_cursor.execute("SELECT rowid, id64 FROM CachedSystems WHERE rowid > ? AND cacheType = ? ORDER BY rowid LIMIT ?",
+                                             (last_row_id, cache_type, RseData.DB_LOAD_CHUNK_SIZE))
+                rows = self.local_db_cursor.fetchall()
+                if len(rows) == 0:
+                    break
+                for last_row_id, id64 in rows:
+                    cache.add(id64)
+                yield
+        self.merge_permanent_caches()
+        yield
+
+        last_row_id = -1
+        while True:
+            self.local_db_cursor.execute("SELECT rowid, id64, name, x, y, z, uncertainty, action FROM RseSystems WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                                         (last_row_id, RseData.DB_LOAD_CHUNK_SIZE))
+            rows = self.local_db_cursor.fetchall()
+            if len(rows) == 0:
+                break
+            for row in rows:
+                last_row_id = row[0]
+                rse_row = tuple(row[1:])
+                # systems in areas that were queried during this session are more recent than the local database
+                if rse_row[ROW_ID64] not in self.spatial_index and not self.spatial_index.is_point_covered(rse_row[ROW_X], rse_row[ROW_Y], rse_row[ROW_Z]):
+                    self.spatial_index.add_row(rse_row)
+            yield
+
+        self.local_db_cursor.execute("SELECT x, y, z, radius, flags, queryDate FROM RseCoverage")
+        for x, y, z, radius, flags, query_date in self.local_db_cursor.fetchall():
+            self.spatial_index.add_coverage(CoveredSphere(x, y, z, radius, CoveredSphere.flags_from_text(flags), query_date))
+        logger.debug(f"Loaded {len(self.spatial_index)} systems into the local index.")
+
+    def is_loading(self) -> bool:
+        return self.__loader is not None
+
+    def load_next_chunk(self):
+        """
+        Load the next chunk of local data. Must be called by the background worker while is_loading returns True.
+        """
+        if self.__loader is None:
+            return
+        try:
+            with self.metrics.timer("sqlite.load_chunk"), self.transaction():
+                next(self.__loader)
+        except StopIteration:
+            self.__loader = None
+        except Exception:
+            self.__loader = None
+            raise
+
+    def load_projects(self) -> bool:
+        """
+        Read the projects from the local database.
+        :return: True if the projects are missing or outdated and should be fetched with fetch_projects
+        """
+        if not self.is_local_database_accessible():
+            return True
+
+        self.local_db_cursor.execute("SELECT id, actionText, name, explanation, enabled, fetchDate FROM Projects")
+        projects_dict = dict()
+        fetch_date = 0
+        for project_id, action_text, name, explanation, enabled, fetch_date in self.local_db_cursor.fetchall():
+            projects_dict[project_id] = RseProject(project_id, action_text, name, explanation, enabled)
+        if len(projects_dict) > 0:
+            self.projects_dict = projects_dict
+        return len(projects_dict) == 0 or fetch_date + RseData.PROJECTS_TTL <= time.time()
+
+    def fetch_projects(self) -> Optional[List[Dict]]:
+        """
+        Query the remote database for information about the projects. Doesn't access any local data and can be called
+        from any thread. Pass the result to set_projects.
+        """
+        response = self._query_rse_api(RseData.PROJECTS_URL)
+        if not response and len(self.projects_dict) == 0:
+            errorMessage = "Could not get information about projects."
+            logger.error(errorMessage)
+            plug.show_error("{plugin_name}-{version}: {msg}".format(plugin_name=RseData.PLUGIN_NAME, version=RseData.VERSION, msg=errorMessage))
+        return response
+
+    def set_projects(self, response: List[Dict]):
+        projects_dict = dict()
+        for _row in response:
+            rseProject = RseProject(_row["id"], _row["action_text"], _row["project_name"], _row["explanation"], _row["enabled"])
+            projects_dict[rseProject.project_id] = rseProject
+        self.projects_dict = projects_dict  # replace instead of changing it, the dictionary is used by the UI thread
 
-    def add_system_to_cache(self, id64: int, expiration_time: int, cache_type: int, handle_db_connection: bool = True):
-        if handle_db_connection:
-            self.open_local_database()
         if self.is_local_database_accessible():
-            self.local_db_cursor.execute("INSERT OR REPLACE INTO CachedSystems VALUES (?, ?, ?)", (id64, expiration_time, cache_type))
-            self.local_db_connection.commit()
-        if handle_db_connection:
-            self.close_local_database()
+            now = time.time()
+            with self.transaction():
+                self.local_db_cursor.execute("DELETE FROM Projects")
+                self.local_db_cursor.executemany("INSERT INTO Projects VALUES (?, ?, ?, ?, ?, ?)",
+                                                 [(p.project_id, p.action_text, p.name, p.explanation, p.enabled, now) for p in projects_dict.values()])
 
-    def initialize(self):
-        # initialize local cache
+    def _migrate_cached_systems(self):
+        """
+        Older versions allowed only one cache per system. Change the primary key to (id64, cacheType), so e.g. a system
+        with confirmed coordinates can be ignored at the same time.
+        sqlite3 commits ALTER and CREATE right away unless a transaction was started explicitly. The migration runs in
+        its own BEGIN ... COMMIT and the rows of a CachedSystemsOld table that was left behind by an interrupted
+        migration of an older version are copied as well.
+        """
+        self.local_db_cursor.execute("PRAGMA table_info(`CachedSystems`)")
+        primary_key_columns = [column[1] for column in self.local_db_cursor.fetchall() if column[5] > 0]
+        self.local_db_cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'CachedSystemsOld'")
+        left_behind = self.local_db_cursor.fetchone() is not None
+        if primary_key_columns != ["id64"] and not left_behind:
+            return  # new database or already migrated
+        logger.debug("Changing primary key of table CachedSystems.")
+        if not self.local_db_connection.in_transaction:
+            self.local_db_cursor.execute("BEGIN")  # committed by the transaction of initialize
+        if primary_key_columns == ["id64"]:
+            if left_behind:
+                self.local_db_cursor.execute("INSERT OR REPLACE INTO `CachedSystemsOld` SELECT id64, expirationDate, cacheType FROM `CachedSystems`")
+                self.local_db_cursor.execute("DROP TABLE `CachedSystems`")
+            else:
+                self.local_db_cursor.execute("ALTER TABLE `CachedSystems` RENAME TO `CachedSystemsOld`")
+        self.local_db_cursor.execute("""CREATE TABLE IF NOT EXISTS `CachedSystems` (
+                                        `id64`	          INTEGER,
+                                        `expirationDate`  REAL NOT NULL,
+                                        `cacheType`	      INTEGER NOT NULL,
+                                        PRIMARY KEY(`id64`, `cacheType`));""")
+        self.local_db_cursor.execute("INSERT OR REPLACE INTO `CachedSystems` SELECT id64, expirationDate, cacheType FROM `CachedSystemsOld`")
+        self.local_db_cursor.execute("DROP TABLE `CachedSystemsOld`")
+
+    def initialize(self) -> bool:
+        """
+        Prepare the local database and read everything that is needed to handle the first tasks. The rest is loaded
+        later in chunks, see load_next_chunk.
+
+        :return: True if the projects are missing or outdated and should be fetched with fetch_projects
+        """
+        # initialize local cache. the connection stays open until the background worker stops
         self.open_local_database()
         if self.is_local_database_accessible():
-            self.local_db_cursor.execute("""CREATE TABLE IF NOT EXISTS `CachedSystems` (
-                                            `id64`	          INTEGER,
-                                            `expirationDate`  REAL NOT NULL,
-                                            `cacheType`	      INTEGER NOT NULL,
-                                            PRIMARY KEY(`id64`));""")
-            self.local_db_connection.commit()
-            self.remove_expired_systems_from_caches(handle_db_connection=False)
-
-            # read cached systems
-            self.local_db_cursor.execute("SELECT id64, cacheType FROM CachedSystems")
+            with self.transaction():
+                self._migrate_cached_systems()
+                self.local_db_cursor.execute("""CREATE TABLE IF NOT EXISTS `CachedSystems` (
+                                                `id64`	          INTEGER,
+                                                `expirationDate`  REAL NOT NULL,
+                                                `cacheType`	      INTEGER NOT NULL,
+                                                PRIMARY KEY(`id64`, `cacheType`));""")
+                self.local_db_cursor.execute("""CREATE TABLE IF NOT EXISTS `RseSystems` (
+                                                `id64`	          INTEGER,
+                                                `name`	          TEXT NOT NULL,
+                                                `x`	              REAL NOT NULL,
+                                                `y`	              REAL NOT NULL,
+                                                `z`	              REAL NOT NULL,
+                                                `uncertainty`     INTEGER NOT NULL,
+                                                `action`          INTEGER NOT NULL,
+                                                `lastSeen`        REAL NOT NULL,
+                                                PRIMARY KEY(`id64`));""")
+                self.local_db_cursor.execute("""CREATE TABLE IF NOT EXISTS `RseCoverage` (
+                                                `x`	              REAL NOT NULL,
+                                                `y`	              REAL NOT NULL,
+                                                `z`	              REAL NOT NULL,
+                                                `radius`          REAL NOT NULL,
+                                                `flags`           TEXT NOT NULL,
+                                                `queryDate`       REAL NOT NULL);""")
+                self.local_db_cursor.execute("""CREATE TABLE IF NOT EXISTS `Projects` (
+                                                `id`	          INTEGER,
+                                                `actionText`      TEXT NOT NULL,
+                                                `name`	          TEXT NOT NULL,
+                                                `explanation`     TEXT NOT NULL,
+                                                `enabled`         INTEGER NOT NULL,
+                                                `fetchDate`       REAL NOT NULL,
+                                                PRIMARY KEY(`id`));""")
+                self.local_db_cursor.execute("CREATE INDEX IF NOT EXISTS `CachedSystemsExpiration` ON `CachedSystems` (`expirationDate`);")
+                self.remove_expired_systems_from_caches()
+
+            # read short lived caches, permanent caches are memory-mapped and their remaining rows are loaded in chunks
+            permanent_caches = list(RseData.PERMANENT_CACHES.keys())
+            self.local_db_cursor.execute("SELECT id64, expirationDate, cacheType FROM CachedSystems WHERE cacheType NOT IN ({})"
+                                         .format(", ".join("?" * len(permanent_caches))), permanent_caches)
             for row in self.local_db_cursor.fetchall():
-                id64, cacheType = row
-                self.get_cached_set(cacheType).add(id64)
-            self.close_local_database()
+                id64, expirationDate, cacheType = row
+                self.get_cached_set(cacheType).add(id64, expirationDate)
+            self.__loader = self._load_local_data()
 
         # initialize dictionaries
-        if len(self.projects_dict) == 0:
-            response = self._query_rse_api("https://cyberlord.de/rse/projects.py")
-            if not response:
-                errorMessage = "Could not get information about projects."
-                logger.error(errorMessage)
-                plug.show_error("{plugin_name}-{version}: {msg}".format(plugin_name=RseData.PLUGIN_NAME, version=RseData.VERSION, msg=errorMessage))
-            else:
-                for _row in response:
-                    rseProject = RseProject(_row["id"], _row["action_text"], _row["project_name"], _row["explanation"], _row["enabled"])
-                    self.projects_dict[rseProject.project_id] = rseProject
+        return self.load_projects()
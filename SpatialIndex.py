@@ -0,0 +1,201 @@
+"""
+EDSM-RSE a plugin for EDMC
+Copyright (C) 2019 Sebastian Bauer
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import math
+
+from typing import Dict, List, Tuple, Union, FrozenSet, Iterable
+
+# (id64, name, x, y, z, uncertainty, action)
+RseRow = Tuple[int, str, float, float, float, int, int]
+CellKey = Tuple[int, int, int]
+
+ROW_ID64 = 0
+ROW_NAME = 1
+ROW_X = 2
+ROW_Y = 3
+ROW_Z = 4
+ROW_UNCERTAINTY = 5
+ROW_ACTION = 6
+
+
+def row_from_json(json_row: Dict) -> RseRow:
+    return (json_row["id"], json_row["name"], json_row["x"], json_row["y"], json_row["z"],
+            json_row["uncertainty"], json_row["action_todo"])
+
+
+def row_matches_flags(row: RseRow, flags: FrozenSet[int]) -> bool:
+    """ Same filter as the remote database: an empty set of flags means all projects. """
+    return not flags or row[ROW_ACTION] in flags
+
+
+class CoveredSphere(object):
+    """
+    A sphere that was queried from the remote database. Every system inside of it that matches the flags is known locally.
+    """
+    def __init__(self, x: float, y: float, z: float, radius: float, flags: FrozenSet[int], query_date: float):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.radius = radius
+        self.flags = flags
+        self.query_date = query_date
+
+    def contains(self, x: float, y: float, z: float, radius: float, flags: FrozenSet[int]) -> bool:
+        if self.flags and (not flags or not flags.issubset(self.flags)):
+            return False  # the remote query was filtered and doesn't include all requested projects
+        distance = math.sqrt((self.x - x) ** 2 + (self.y - y) ** 2 + (self.z - z) ** 2)
+        return distance + radius <= self.radius
+
+    def flags_to_text(self) -> str:
+        return ",".join(str(flag) for flag in sorted(self.flags))
+
+    @staticmethod
+    def flags_from_text(text: str) -> FrozenSet[int]:
+        return frozenset(int(flag) for flag in text.split(",") if flag)
+
+
+class SpatialIndex(object):
+    """
+    Uniform grid of every RSE system received from the remote database.
+    Nearest target queries are answered locally as long as the queried sphere lies within a sphere that was
+    fetched from the remote database less than COVERAGE_TTL seconds ago.
+    """
+
+    CELL_SIZE = 250  # edge length of a grid cell in ly
+    COVERAGE_TTL = 60 * 60  # remote data is considered fresh for this many seconds
+    MAX_ROW_AGE = 7 * 24 * 3600  # rows that weren't seen for this long are removed from the database
+    TILE_FRACTION = 4  # edge length of a query tile is between 1/TILE_FRACTION and 2/TILE_FRACTION of the query radius
+
+    def __init__(self):
+        self.__cells: Dict[CellKey, Dict[int, RseRow]] = dict()
+        self.__cell_of_system: Dict[int, CellKey] = dict()  # key = ID64
+        self.__coverage: List[CoveredSphere] = list()
+
+    def __len__(self):
+        return len(self.__cell_of_system)
+
+    def __contains__(self, id64: int) -> bool:
+        return id64 in self.__cell_of_system
+
+    @staticmethod
+    def _cell_key(x: Union[int, float], y: Union[int, float], z: Union[int, float]) -> CellKey:
+        size = SpatialIndex.CELL_SIZE
+        return math.floor(x / size), math.floor(y / size), math.floor(z / size)
+
+    def _cells_in_box(self, x: float, y: float, z: float, radius: float) -> Iterable[Dict[int, RseRow]]:
+        min_x, min_y, min_z = self._cell_key(x - radius, y - radius, z - radius)
+        max_x, max_y, max_z = self._cell_key(x + radius, y + radius, z + radius)
+        number_of_cells = (max_x - min_x + 1) * (max_y - min_y + 1) * (max_z - min_z + 1)
+        if number_of_cells > len(self.__cells):
+            # large radius, most cells in the box are empty anyway
+            return [cell for key, cell in self.__cells.items()
+                    if min_x <= key[0] <= max_x and min_y <= key[1] <= max_y and min_z <= key[2] <= max_z]
+        cells = list()
+        for cx in range(min_x, max_x + 1):
+            for cy in range(min_y, max_y + 1):
+                for cz in range(min_z, max_z + 1):
+                    cell = self.__cells.get((cx, cy, cz))
+                    if cell:
+                        cells.append(cell)
+        return cells
+
+    @staticmethod
+    def get_tile_sphere(x: float, y: float, z: float, radius: float) -> Tuple[float, float, float, float]:
+        """
+        Snap a query to a grid of cubic tiles. The edge length of the tiles is a power of two, so similar radii share
+        the same grid. The returned sphere is centred on the tile and contains the query sphere of every position
+        inside the tile, so one remote query answers all queries with this radius from the same tile.
+        :return: x, y, z and radius of the sphere to query
+        """
+        size = 2 ** math.ceil(math.log2(max(radius / SpatialIndex.TILE_FRACTION, 1)))
+        tile_x = (math.floor(x / size) + 0.5) * size
+        tile_y = (math.floor(y / size) + 0.5) * size
+        tile_z = (math.floor(z / size) + 0.5) * size
+        return tile_x, tile_y, tile_z, radius + size * math.sqrt(3) / 2
+
+    def add_row(self, row: RseRow):
+        id64 = row[ROW_ID64]
+        key = self._cell_key(row[ROW_X], row[ROW_Y], row[ROW_Z])
+        old_key = self.__cell_of_system.get(id64)
+        if old_key is not None and old_key != key:
+            self.remove_system(id64)
+        self.__cells.setdefault(key, dict())[id64] = row
+        self.__cell_of_system[id64] = key
+
+    def remove_system(self, id64: int):
+        key = self.__cell_of_system.pop(id64, None)
+        if key is None:
+            return
+        cell = self.__cells[key]
+        del cell[id64]
+        if len(cell) == 0:
+            del self.__cells[key]
+
+    def add_coverage(self, covered_sphere: CoveredSphere):
+        self.__coverage.append(covered_sphere)
+
+    def get_coverage(self) -> List[CoveredSphere]:
+        return self.__coverage
+
+    def remove_expired_coverage(self, now: float):
+        self.__coverage = [c for c in self.__coverage if c.query_date + SpatialIndex.COVERAGE_TTL > now]
+
+    def covers(self, x: float, y: float, z: float, radius: float, flags: FrozenSet[int], now: float) -> bool:
+        """
+        Check if the sphere can be answered with local data only.
+        """
+        for covered_sphere in self.__coverage:
+            if covered_sphere.query_date + SpatialIndex.COVERAGE_TTL > now and covered_sphere.contains(x, y, z, radius, flags):
+                return True
+        return False
+
+    def is_point_covered(self, x: float, y: float, z: float) -> bool:
+        for covered_sphere in self.__coverage:
+            if (covered_sphere.x - x) ** 2 + (covered_sphere.y - y) ** 2 + (covered_sphere.z - z) ** 2 <= covered_sphere.radius ** 2:
+                return True
+        return False
+
+    def query(self, x: float, y: float, z: float, radius: float, flags: FrozenSet[int]) -> List[RseRow]:
+        """
+        Return all known systems within radius that match the flags. The result is not sorted.
+        """
+        squared_radius = radius * radius
+        rows = list()
+        for cell in self._cells_in_box(x, y, z, radius):
+            for row in cell.values():
+                if (row[ROW_X] - x) ** 2 + (row[ROW_Y] - y) ** 2 + (row[ROW_Z] - z) ** 2 <= squared_radius and row_matches_flags(row, flags):
+                    rows.append(row)
+        return rows
+
+    def replace_sphere(self, covered_sphere: CoveredSphere, rows: List[RseRow]) -> List[int]:
+        """
+        Store the result of a remote query. Systems inside the sphere that match the flags but aren't part of the
+        response anymore have been completed by someone else and are removed.
+        :return: list of ID64 that were removed
+        """
+        received = set(row[ROW_ID64] for row in rows)
+        stale = [row[ROW_ID64] for row in self.query(covered_sphere.x, covered_sphere.y, covered_sphere.z, covered_sphere.radius, covered_sphere.flags)
+                 if row[ROW_ID64] not in received]
+        for id64 in stale:
+            self.remove_system(id64)
+        for row in rows:
+            self.add_row(row)
+        self.remove_expired_coverage(covered_sphere.query_date)
+        self.add_coverage(covered_sphere)
+        return stale
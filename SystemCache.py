@@ -0,0 +1,271 @@
+"""
+EDSM-RSE a plugin for EDMC
+Copyright (C) 2019 Sebastian Bauer
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import bisect
+import heapq
+import math
+import mmap
+import os
+import time
+
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
+
+
+class ExpiringSet(object):
+    """
+    Set of ID64 where every entry has an expiration date. Expired entries are never reported as members, even before
+    remove_expired is called. A min-heap of (expiration date, ID64) allows remove_expired to only touch expired entries.
+    """
+
+    NEVER = math.inf
+
+    def __init__(self):
+        self.__expiration_dates: Dict[int, float] = dict()  # key = ID64
+        self.__heap: List[Tuple[float, int]] = list()  # may contain outdated entries, see remove_expired
+
+    def __contains__(self, id64: int) -> bool:
+        expiration_date = self.__expiration_dates.get(id64)
+        return expiration_date is not None and (expiration_date == ExpiringSet.NEVER or expiration_date > time.time())
+
+    def __len__(self):
+        return len(self.__expiration_dates)
+
+    def __iter__(self) -> Iterator[int]:
+        now = time.time()
+        return iter([id64 for id64, expiration_date in self.__expiration_dates.items() if expiration_date > now])
+
+    def add(self, id64: int, expiration_date: Union[int, float] = NEVER):
+        """
+        Add a system or replace its expiration date.
+        """
+        self.__expiration_dates[id64] = expiration_date
+        if expiration_date != ExpiringSet.NEVER:
+            heapq.heappush(self.__heap, (expiration_date, id64))
+            if len(self.__heap) > 2 * len(self.__expiration_dates) + 64:
+                self._rebuild_heap()
+
+    def update(self, id64s: Iterable[int], expiration_date: Union[int, float] = NEVER):
+        for id64 in id64s:
+            self.add(id64, expiration_date)
+
+    def discard(self, id64: int):
+        self.__expiration_dates.pop(id64, None)  # the heap entry is skipped once it expires
+
+    def remove(self, id64: int):
+        del self.__expiration_dates[id64]
+
+    def clear(self):
+        self.__expiration_dates.clear()
+        self.__heap.clear()
+
+    def remove_expired(self, now: Optional[float] = None) -> List[int]:
+        """
+        Remove all entries that expired.
+        :return: list of removed ID64
+        """
+        if now is None:
+            now = time.time()
+        removed = list()
+        while self.__heap and self.__heap[0][0] <= now:
+            expiration_date, id64 = heapq.heappop(self.__heap)
+            if self.__expiration_dates.get(id64) == expiration_date:  # otherwise the entry was replaced or removed
+                del self.__expiration_dates[id64]
+                removed.append(id64)
+        return removed
+
+    def _rebuild_heap(self):
+        self.__heap = [(expiration_date, id64) for id64, expiration_date in self.__expiration_dates.items() if expiration_date != ExpiringSet.NEVER]
+        heapq.heapify(self.__heap)
+
+
+class CacheView(object):
+    """
+    Read-only view of several caches. Membership is checked against the original sets, nothing is copied.
+    """
+
+    def __init__(self, *caches: ExpiringSet):
+        self.__caches = caches
+
+    def __contains__(self, id64: int) -> bool:
+        for cache in self.__caches:
+            if id64 in cache:
+                return True
+        return False
+
+
+class PermanentIdSet(object):
+    """
+    Set of ID64 that never expire, e.g. fully scanned systems.
+    Most entries are kept in a sorted file of unsigned 64 bit integers that is memory-mapped and searched with bisect.
+    New entries are kept in a small in-memory delta until merge writes a new file. The caller is responsible to persist
+    the delta in the meantime.
+    Every merge writes a new file generation instead of replacing the mapped file, so readers on other threads can keep
+    using the old mapping.
+    """
+
+    ITEM_SIZE = 8  # bytes per ID64
+
+    def __init__(self, directory: str, name: str):
+        self.directory = directory
+        self.name = name
+        self.__delta: Set[int] = set()
+        self.__generation = 0
+        self.__ids: Sequence[int] = array("Q")  # sorted, read-only
+        self._open_newest_generation()
+
+    def _get_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"{self.name}.{generation}.bin")
+
+    def _list_generations(self) -> List[int]:
+        generations = list()
+        prefix, suffix = self.name + ".", ".bin"
+        try:
+            file_names = os.listdir(self.directory)
+        except OSError:
+            return generations
+        for file_name in file_names:
+            if file_name.startswith(prefix) and file_name.endswith(suffix) and file_name[len(prefix):-len(suffix)].isdigit():
+                generations.append(int(file_name[len(prefix):-len(suffix)]))
+        return sorted(generations)
+
+    def _remove_old_generations(self):
+        for generation in self._list_generations():
+            if generation != self.__generation:
+                try:
+                    os.remove(self._get_path(generation))
+                except OSError:
+                    pass  # still mapped (Windows), try again after the next merge or restart
+
+    def _open_newest_generation(self):
+        generations = self._list_generations()
+        if len(generations) == 0:
+            return
+        self._map_generation(generations[-1])
+        self._remove_old_generations()
+
+    def _map_generation(self, generation: int):
+        path = self._get_path(generation)
+        ids: Sequence[int] = array("Q")
+        if os.path.getsize(path) >= PermanentIdSet.ITEM_SIZE:
+            with open(path, "rb") as f:
+                mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            ids = memoryview(mapped_file)[:len(mapped_file) // PermanentIdSet.ITEM_SIZE * PermanentIdSet.ITEM_SIZE].cast("Q")
+        self.__ids = ids
+        self.__generation = generation
+
+    def __contains__(self, id64: int) -> bool:
+        if id64 in self.__delta:
+            return True
+        ids = self.__ids  # keep a reference in case another thread merges
+        index = bisect.bisect_left(ids, id64)
+        return index < len(ids) and ids[index] == id64
+
+    def __len__(self):
+        return len(self.__ids) + len(self.__delta)
+
+    def add(self, id64: int, expiration_date: Union[int, float] = ExpiringSet.NEVER):
+        if id64 not in self:
+            self.__delta.add(id64)
+
+    def update(self, id64s: Iterable[int], expiration_date: Union[int, float] = ExpiringSet.NEVER):
+        for id64 in id64s:
+            self.add(id64)
+
+    def discard(self, id64: int):
+        self.__delta.discard(id64)  # entries in the file are only removed by clear
+
+    def remove_expired(self, now: Optional[float] = None) -> List[int]:
+        return list()  # entries never expire
+
+    def get_delta_size(self) -> int:
+        return len(self.__delta)
+
+    def merge(self) -> Set[int]:
+        """
+        Write a new file that contains all entries and clear the delta.
+        :return: the merged delta
+        """
+        delta = self.__delta
+        if len(delta) == 0:
+            return delta
+        generation = self.__generation + 1
+        path = self._get_path(generation)
+        buffer = array("Q")
+        with open(path + ".tmp", "wb") as f:
+            last_id64 = None
+            for id64 in heapq.merge(self.__ids, sorted(delta)):
+                if id64 != last_id64:
+                    buffer.append(id64)
+                    last_id64 = id64
+                if len(buffer) >= 65536:
+                    buffer.tofile(f)
+                    buffer = array("Q")
+            buffer.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+        self._map_generation(generation)
+        self.__delta = set()
+        self._remove_old_generations()
+        return delta
+
+    def clear(self):
+        self.__delta = set()
+        self.__ids = array("Q")
+        self.__generation += 1
+        self._remove_old_generations()
+
+
+class LruCache(object):
+    """
+    Small cache of values by ID64. Entries expire after ttl seconds and the least recently used entry is dropped once
+    more than max_size entries are stored.
+    """
+
+    def __init__(self, max_size: int, ttl: Union[int, float]):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.__entries: "OrderedDict[int, Tuple[float, Any]]" = OrderedDict()  # key = ID64, value = (expiration date, value)
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, id64: int) -> bool:
+        """ Check for a valid entry without marking it as used. """
+        entry = self.__entries.get(id64)
+        return entry is not None and entry[0] > time.time()
+
+    def get(self, id64: int, default: Any = None) -> Any:
+        entry = self.__entries.get(id64)
+        if entry is None:
+            return default
+        if entry[0] <= time.time():
+            del self.__entries[id64]
+            return default
+        self.__entries.move_to_end(id64)
+        return entry[1]
+
+    def put(self, id64: int, value: Any):
+        self.__entries[id64] = (time.time() + self.ttl, value)
+        self.__entries.move_to_end(id64)
+        while len(self.__entries) > self.max_size:
+            self.__entries.popitem(last=False)
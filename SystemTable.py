@@ -0,0 +1,200 @@
+"""
+EDSM-RSE a plugin for EDMC
+Copyright (C) 2019 Sebastian Bauer
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import sys
+
+from array import array
+from typing import Dict, Iterator, List, Optional, Set, Tuple, Union
+
+from DistanceFilter import CoordinateArrays
+
+
+class SystemView(object):
+    """
+    Detached copy of one row of a SystemTable. Changing the table afterwards doesn't affect the view.
+    """
+    __slots__ = ("id64", "name", "x", "y", "z", "uncertainty", "distance", "projects", "projects_dict")
+
+    def __init__(self, id64: int, name: str, x: float, y: float, z: float, uncertainty: int, distance: float, projects: int, projects_dict: Dict):
+        self.id64 = id64
+        self.name = name
+        self.x = x
+        self.y = y
+        self.z = z
+        self.uncertainty = uncertainty
+        self.distance = distance
+        self.projects = projects  # bit mask of project IDs
+        self.projects_dict = projects_dict  # RseData.projects_dict, key = project ID
+
+    def get_action_text(self) -> str:
+        return ", ".join([rse_project.action_text for project_id, rse_project in self.projects_dict.items() if self.projects & project_id])
+
+    def __str__(self):
+        return "id64: {id64}, name: {name}, distance: {distance:,.2f}, uncertainty: {uncertainty}"\
+            .format(id64=self.id64, name=self.name, distance=self.distance, uncertainty=self.uncertainty)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class SystemTable(object):
+    """
+    Nearby systems sorted by distance, stored as parallel arrays instead of one object per system.
+    Rows are addressed by their index. Removed rows are only marked and skipped until the table is compacted, so
+    removing a system doesn't move the other rows. Indices change when the table is compacted or sorted again.
+    """
+
+    COMPACT_THRESHOLD = 64  # compact when at least this many rows and half of the table are removed
+
+    def __init__(self):
+        self.id64s = array("Q")
+        self.names: List[str] = list()
+        self.xs = array("d")
+        self.ys = array("d")
+        self.zs = array("d")
+        self.uncertainties = array("l")
+        self.distances = array("d")
+        self.projects = array("L")  # bit mask of project IDs
+
+        self.__row_by_id64: Dict[int, int] = dict()
+        self.__row_by_name: Dict[str, int] = dict()  # key = casefolded name
+        self.__removed_rows: Set[int] = set()
+        self.__rows_without_projects: Set[int] = set()
+        self.__head = 0  # all rows before this one are removed
+
+    def __len__(self):
+        return len(self.id64s) - len(self.__removed_rows)
+
+    def append(self, id64: int, name: str, x: float, y: float, z: float, uncertainty: int, distance: float, projects: int):
+        index = len(self.id64s)
+        self.id64s.append(id64)
+        self.names.append(sys.intern(name))
+        self.xs.append(x)
+        self.ys.append(y)
+        self.zs.append(z)
+        self.uncertainties.append(uncertainty)
+        self.distances.append(distance)
+        self.projects.append(projects)
+        self.__row_by_id64[id64] = index
+        self.__row_by_name[name.casefold()] = index
+        if projects == 0:
+            self.__rows_without_projects.add(index)
+
+    def rows(self, limit: Optional[int] = None) -> Iterator[int]:
+        """ Indices of all rows that weren't removed, closest first. """
+        count = 0
+        for index in range(self.__head, len(self.id64s)):
+            if limit is not None and count >= limit:
+                return
+            if index not in self.__removed_rows:
+                count += 1
+                yield index
+
+    def first(self) -> Optional[int]:
+        return next(self.rows(1), None)
+
+    def get_view(self, index: int, projects_dict: Dict) -> SystemView:
+        return SystemView(self.id64s[index], self.names[index], self.xs[index], self.ys[index], self.zs[index],
+                          self.uncertainties[index], self.distances[index], self.projects[index], projects_dict)
+
+    def get_closest_views(self, x: Union[int, float], y: Union[int, float], z: Union[int, float], limit: int, projects_dict: Dict) -> List[SystemView]:
+        """
+        Views of the rows closest to the given coordinates, with their distances to them. The table isn't sorted.
+        """
+        indices = list(self.rows())
+        coordinates = CoordinateArrays((self.xs[index], self.ys[index], self.zs[index], 1) for index in indices)
+        views = list()
+        for position, distance in coordinates.nearest(x, y, z)[:limit]:
+            view = self.get_view(indices[position], projects_dict)
+            view.distance = distance
+            views.append(view)
+        return views
+
+    def find_id64(self, id64: int) -> Optional[int]:
+        return self.__row_by_id64.get(id64)
+
+    def find_name(self, name: str) -> Optional[int]:
+        return self.__row_by_name.get(name.casefold())
+
+    def remove_from_project(self, index: int, project_id: int):
+        self.projects[index] = self.projects[index] & ~project_id
+        if self.projects[index] == 0:
+            self.__rows_without_projects.add(index)
+
+    def remove_rows(self, indices: Set[int]) -> List[Tuple[int, str]]:
+        """
+        :return: list of (ID64, name) of the removed systems
+        """
+        removed_systems = list()
+        for index in indices:
+            if index in self.__removed_rows:
+                continue
+            id64, name = self.id64s[index], self.names[index]
+            removed_systems.append((id64, name))
+            self.__removed_rows.add(index)
+            self.__rows_without_projects.discard(index)
+            if self.__row_by_id64.get(id64) == index:
+                del self.__row_by_id64[id64]
+            if self.__row_by_name.get(name.casefold()) == index:
+                del self.__row_by_name[name.casefold()]
+        while self.__head in self.__removed_rows:
+            self.__head += 1
+
+        if len(self.__removed_rows) >= SystemTable.COMPACT_THRESHOLD and len(self.__removed_rows) * 2 >= len(self.id64s):
+            self.compact()
+        return removed_systems
+
+    def remove_systems_without_projects(self) -> List[Tuple[int, str]]:
+        """
+        Remove all systems that aren't part of any project anymore.
+        :return: list of (ID64, name) of the removed systems
+        """
+        if len(self.__rows_without_projects) == 0:
+            return list()
+        return self.remove_rows(set(self.__rows_without_projects))
+
+    def compact(self):
+        """ Drop removed rows from the arrays. """
+        self._keep_rows(list(self.rows()))
+
+    def _keep_rows(self, indices: List[int]):
+        self.id64s = array("Q", (self.id64s[i] for i in indices))
+        self.names = [self.names[i] for i in indices]
+        self.xs = array("d", (self.xs[i] for i in indices))
+        self.ys = array("d", (self.ys[i] for i in indices))
+        self.zs = array("d", (self.zs[i] for i in indices))
+        self.uncertainties = array("l", (self.uncertainties[i] for i in indices))
+        self.distances = array("d", (self.distances[i] for i in indices))
+        self.projects = array("L", (self.projects[i] for i in indices))
+
+        self.__removed_rows.clear()
+        self.__head = 0
+        self.__row_by_id64 = {id64: index for index, id64 in enumerate(self.id64s)}
+        self.__row_by_name = {name.casefold(): index for index, name in enumerate(self.names)}
+        self.__rows_without_projects = set(index for index, projects in enumerate(self.projects) if projects == 0)
+
+    def sort_by_distance(self, x: Union[int, float], y: Union[int, float], z: Union[int, float]):
+        """
+        Recalculate all distances to the given coordinates and sort the table.
+        """
+        self.compact()
+        coordinates = CoordinateArrays((sx, sy, sz, 1) for sx, sy, sz in zip(self.xs, self.ys, self.zs))
+        nearest = coordinates.nearest(x, y, z)
+        self._keep_rows([index for index, _ in nearest])
+        self.distances = array("d", (distance for _, distance in nearest))
@@ -0,0 +1,146 @@
+"""
+EDSM-RSE a plugin for EDMC
+Copyright (C) 2019 Sebastian Bauer
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import threading
+import time
+
+from collections import deque
+from queue import Empty
+from typing import Any, Callable, Deque, Dict, Optional, Tuple, Union
+
+
+def supersede(pending: Any, task: Any) -> Optional[Any]:
+    """
+    Return what should happen to a pending task once task is queued: the pending task itself, the replacement from
+    its superseded method or None to drop it.
+    """
+    key = getattr(task, "supersede_key", None)
+    if key is None or getattr(pending, "supersede_key", None) != key:
+        return pending
+    return pending.superseded()
+
+
+class WaitStatistics(object):
+    """
+    Time between creating a task and executing it, per priority class.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counts: Dict[int, int] = dict()  # key = priority
+        self.__total_wait: Dict[int, float] = dict()
+        self.__max_wait: Dict[int, float] = dict()
+
+    def add(self, priority: int, wait: float):
+        with self.__lock:
+            self.__counts[priority] = self.__counts.get(priority, 0) + 1
+            self.__total_wait[priority] = self.__total_wait.get(priority, 0) + wait
+            self.__max_wait[priority] = max(self.__max_wait.get(priority, 0), wait)
+
+    def __str__(self):
+        with self.__lock:
+            return ", ".join(f"priority {priority}: {count} tasks, average {self.__total_wait[priority] / count:.3f}s, max {self.__max_wait[priority]:.3f}s"
+                             for priority, count in sorted(self.__counts.items())) or "no tasks"
+
+
+class TaskQueue(object):
+    """
+    Priority queue for the background worker with the interface of queue.Queue that is used by the worker.
+    Items are handed out by priority (lowest number first) and in FIFO order within a priority. Items that waited for
+    MAX_WAIT seconds are handed out before everything else, so low priorities don't starve.
+    Tasks with a supersede key replace all pending tasks with the same key, see BackgroundTask.supersede_key.
+    None (stop the worker) is handed out after all tasks, anything else is queued as it is with the highest priority.
+    """
+
+    PRIORITY_HIGH = 0  # visible in the UI
+    PRIORITY_NORMAL = 1  # prepares data for later
+    PRIORITY_LOW = 2  # maintenance
+    PRIORITY_STOP = 3  # None, the worker stops after all queued tasks
+    MAX_WAIT = 30  # seconds
+
+    def __init__(self):
+        self.__items: Dict[int, Deque[Tuple[float, Any]]] = dict()  # key = priority, value = (time queued, item)
+        self.__condition = threading.Condition()
+
+    def __len__(self):
+        with self.__condition:
+            return sum(len(items) for items in self.__items.values())
+
+    def qsize(self) -> int:
+        return len(self)
+
+    @staticmethod
+    def get_priority(item: Any) -> int:
+        if item is None:
+            return TaskQueue.PRIORITY_STOP
+        return getattr(item, "priority", TaskQueue.PRIORITY_HIGH)
+
+    def put(self, item: Any):
+        with self.__condition:
+            if getattr(item, "supersede_key", None) is not None:
+                self.replace(lambda pending: supersede(pending, item))
+            self.__items.setdefault(self.get_priority(item), deque()).append((time.monotonic(), item))
+            self.__condition.notify()
+
+    def replace(self, function: Callable[[Any], Optional[Any]]):
+        """
+        Replace every pending item by the result of function. Items are removed if the result is None.
+        A queued None (stop the worker) is always kept.
+        """
+        with self.__condition:
+            for priority, pending_items in self.__items.items():
+                items = deque()
+                for queued, pending in pending_items:
+                    if pending is not None:
+                        pending = function(pending)
+                        if pending is None:
+                            continue
+                    items.append((queued, pending))
+                self.__items[priority] = items
+
+    def _pop(self) -> Any:
+        now = time.monotonic()
+        selected = None
+        for priority in sorted(self.__items.keys()):
+            items = self.__items[priority]
+            if len(items) == 0:
+                continue
+            if selected is None:
+                selected = items  # highest priority
+            elif priority != TaskQueue.PRIORITY_STOP and now - items[0][0] >= TaskQueue.MAX_WAIT and items[0][0] < selected[0][0]:
+                selected = items  # waited too long
+        return selected.popleft()[1]
+
+    def get(self, block: bool = True, timeout: Union[int, float, None] = None) -> Any:
+        """
+        :raises queue.Empty: if no item arrived in time
+        """
+        with self.__condition:
+            if not block:
+                timeout = 0
+            end_time = None if timeout is None else time.monotonic() + timeout
+            while len(self) == 0:
+                remaining = None if end_time is None else end_time - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise Empty
+                self.__condition.wait(remaining)
+            return self._pop()
+
+    def task_done(self):
+        pass  # only kept for compatibility with queue.Queue
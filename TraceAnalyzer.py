@@ -0,0 +1,118 @@
+"""
+EDSM-RSE a plugin for EDMC
+Copyright (C) 2019 Sebastian Bauer
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+# Report of a trace file written by Tracer. Runs without EDMC:
+#     python TraceAnalyzer.py trace.jsonl [trace.old.jsonl] [--slowest 10] [--stage execute]
+
+import argparse
+import json
+import math
+import sys
+
+from typing import Dict, Iterable, List, Optional, TextIO
+
+
+def read_spans(paths: Iterable[str]) -> List[Dict]:
+    spans = list()
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    spans.append(json.loads(line))
+                except ValueError:
+                    print(f"{path}:{line_number}: skipped line that is no JSON", file=sys.stderr)  # e.g. cut off by a crash
+    return spans
+
+
+def get_percentile(sorted_values: List[float], fraction: float) -> float:
+    """ Nearest rank percentile of a sorted list. """
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[max(math.ceil(fraction * len(sorted_values)) - 1, 0)]
+
+
+def get_stage_name(span: Dict) -> str:
+    """ Tasks and hosts are reported separately, e.g. execute:JumpedSystemTask or http:www.edsm.net. """
+    detail = span.get("task") or span.get("host") or span.get("event")
+    return f"{span['stage']}:{detail}" if detail else span["stage"]
+
+
+def report_stages(spans: List[Dict], out: TextIO):
+    durations: Dict[str, List[float]] = dict()
+    for span in spans:
+        durations.setdefault(get_stage_name(span), list()).append(span.get("ms", 0.0))
+    rows = list()
+    for stage, values in durations.items():
+        values.sort()
+        rows.append((stage, len(values), get_percentile(values, 0.5), get_percentile(values, 0.95), get_percentile(values, 0.99), values[-1]))
+    rows.sort(key=lambda row: row[4], reverse=True)
+
+    width = max([len(row[0]) for row in rows] + [5])
+    out.write(f"{'stage':<{width}} {'count':>7} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'max ms':>10}\n")
+    for stage, count, p50, p95, p99, maximum in rows:
+        out.write(f"{stage:<{width}} {count:>7} {p50:>10.1f} {p95:>10.1f} {p99:>10.1f} {maximum:>10.1f}\n")
+
+
+def report_slowest_traces(spans: List[Dict], count: int, out: TextIO, stage: Optional[str] = None):
+    """
+    A trace lasts from the start of its first span to the end of its last one, e.g. from the journal entry of a jump
+    until the UI showed the new target.
+    """
+    traces: Dict[str, List[Dict]] = dict()
+    for span in spans:
+        if span.get("trace"):
+            traces.setdefault(span["trace"], list()).append(span)
+
+    durations = list()
+    for trace_id, trace_spans in traces.items():
+        if stage and not any(get_stage_name(span).startswith(stage) for span in trace_spans):
+            continue
+        start = min(span["start"] for span in trace_spans)
+        end = max(span["start"] + span.get("ms", 0.0) / 1000 for span in trace_spans)
+        durations.append(((end - start) * 1000, trace_id, start, trace_spans))
+    durations.sort(key=lambda entry: entry[0], reverse=True)
+
+    for duration, trace_id, start, trace_spans in durations[:count]:
+        first = min(trace_spans, key=lambda span: span["start"])
+        out.write(f"\ntrace {trace_id}: {duration:.1f} ms, {len(trace_spans)} spans, started by {get_stage_name(first)}\n")
+        for span in sorted(trace_spans, key=lambda s: s["start"]):
+            details = ", ".join(f"{key}={value}" for key, value in span.items() if key not in ("trace", "stage", "start", "ms", "thread"))
+            out.write(f"  +{(span['start'] - start) * 1000:9.1f} ms {span.get('ms', 0.0):9.1f} ms  {span['stage']:<14} {details}\n")
+
+
+def main(arguments: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Latency report of a trace file of the EDSM-RSE plugin.")
+    parser.add_argument("files", nargs="+", help="trace files (trace.jsonl in the plugin directory)")
+    parser.add_argument("--slowest", type=int, default=5, help="number of slowest traces to show (default: 5)")
+    parser.add_argument("--stage", help="only show slow traces that contain this stage, e.g. execute:JumpedSystemTask")
+    args = parser.parse_args(arguments)
+
+    spans = read_spans(args.files)
+    if len(spans) == 0:
+        print("No spans found.")
+        return
+    report_stages(spans, sys.stdout)
+    report_slowest_traces(spans, args.slowest, sys.stdout, args.stage)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+EDSM-RSE a plugin for EDMC
+Copyright (C) 2019 Sebastian Bauer
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import itertools
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional, TextIO
+
+
+class NullSpan(object):
+    """
+    Returned by Tracer.span while tracing is disabled. Does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def __setitem__(self, key: str, value: Any):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+    """
+    Duration of one stage. Attributes can be added with span[name] = value until the with block ends.
+    """
+
+    def __init__(self, tracer: "Tracer", stage: str, attributes: dict):
+        self.tracer = tracer
+        self.stage = stage
+        self.attributes = attributes
+        self.start = 0.0
+        self.__start_counter = 0.0
+
+    def __enter__(self):
+        self.start = time.time()
+        self.__start_counter = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        self.tracer.record(self.stage, self.start, time.perf_counter() - self.__start_counter, **self.attributes)
+        return False
+
+    def __setitem__(self, key: str, value: Any):
+        self.attributes[key] = value
+
+
+class Tracer(object):
+    """
+    Writes one JSON line per span to FILE_NAME in the plugin directory, see TraceAnalyzer.py.
+    Every span belongs to the trace that is current on its thread. A trace is started for every journal entry and is
+    carried along by the tasks that are created while handling it (BackgroundTask.trace_id), so all spans of a jump
+    share the same ID.
+    Tracing is off by default. While disabled, span returns NULL_SPAN and nothing else happens.
+    """
+
+    FILE_NAME = "trace.jsonl"
+    MAX_FILE_SIZE = 20 * 1024 * 1024  # bytes, the file is renamed to trace.old.jsonl when it gets larger
+
+    def __init__(self):
+        self.enabled = False
+        self.__lock = threading.Lock()
+        self.__file: Optional[TextIO] = None
+        self.__path: Optional[str] = None
+        self.__local = threading.local()
+        self.__ids = itertools.count(1)
+        self.__prefix = f"{int(time.time()):x}"  # IDs are unique across restarts of EDMC
+
+    def enable(self, directory: str):
+        with self.__lock:
+            if self.enabled:
+                return
+            self.__path = os.path.join(directory, Tracer.FILE_NAME)
+            self.__file = open(self.__path, "a", encoding="utf-8", buffering=1)  # line buffered, spans survive a crash
+            self.enabled = True
+
+    def disable(self):
+        with self.__lock:
+            self.enabled = False
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
+    def new_trace_id(self) -> str:
+        return f"{self.__prefix}-{next(self.__ids)}"
+
+    def get_trace_id(self) -> Optional[str]:
+        return getattr(self.__local, "trace_id", None)
+
+    def trace(self, trace_id: Optional[str]):
+        """
+        Use as "with tracer.trace(trace_id):" to make trace_id the current trace of this thread for the with block.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return self._trace(trace_id)
+
+    @contextmanager
+    def _trace(self, trace_id: Optional[str]) -> Iterator[None]:
+        previous = self.get_trace_id()
+        self.__local.trace_id = trace_id
+        try:
+            yield
+        finally:
+            self.__local.trace_id = previous
+
+    def span(self, stage: str, **attributes: Any):
+        """
+        Use as "with tracer.span(stage) as span:" to record the duration of the block.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, stage, attributes)
+
+    def event(self, stage: str, **attributes: Any):
+        """
+        Record a span without duration.
+        """
+        if self.enabled:
+            self.record(stage, time.time(), 0.0, **attributes)
+
+    def record(self, stage: str, start: float, duration: float, trace_id: Optional[str] = None, **attributes: Any):
+        """
+        :param start: time.time() at the start of the span
+        :param duration: in seconds
+        :param trace_id: defaults to the current trace of this thread
+        """
+        if not self.enabled:
+            return
+        line = {"trace": trace_id or self.get_trace_id(),
+                "stage": stage,
+                "start": round(start, 6),
+                "ms": round(duration * 1000, 3),
+                "thread": threading.current_thread().name}
+        line.update(attributes)
+        text = json.dumps(line, default=str) + "\n"
+        with self.__lock:
+            if self.__file is None:
+                return
+            self.__file.write(text)
+            if self.__file.tell() > Tracer.MAX_FILE_SIZE:
+                self.__file.close()
+                os.replace(self.__path, self.__path[:-len(".jsonl")] + ".old.jsonl")
+                self.__file = open(self.__path, "a", encoding="utf-8", buffering=1)
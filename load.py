@@ -19,13 +19,13 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 import sys
 import os
+import json
 import time
 import logging
 import semantic_version
 
-from queue import Queue
 from urllib.parse import quote
-from typing import Dict, Union
+from typing import Callable, Dict, List, Union
 
 import tkinter as tk
 import tkinter.ttk as ttk
@@ -36,7 +36,10 @@ from config import config, appname, appversion
 from l10n import Locale
 
 from RseData import RseData, EliteSystem
+from SystemTable import SystemTable
 from Backgroundworker import BackgroundWorker
+from TaskQueue import TaskQueue
+from Tracer import Tracer
 import BackgroundTask as BackgroundTask
 
 logger = logging.getLogger(f"{appname}.{os.path.basename(os.path.dirname(__file__))}")
@@ -64,12 +67,14 @@ this.systemCreated = False  # initialize with false in case someone uses an olde
 this.enabled = False  # plugin configured correctly and therefore enabled
 this.currentSystem = None  # type: Union[EliteSystem, None] # current system
 this.commander = None  # name of current commander
+this.navRoute = list()  # type: List[EliteSystem] # plotted route, including the current system
 
 this.worker = None  # type: Union[BackgroundWorker, None]
-this.queue = None  # type: Union[Queue, None] # queue used by the background worker
+this.queue = None  # type: Union[TaskQueue, None] # queue used by the background worker
 
 # ui elements in options
 this.debug = None  # Type: Union[tk.BooleanVar, None] # toggle debug messages to eddb log
+this.trace = None  # type: Union[tk.BooleanVar, None] # write spans of the background tasks to trace.jsonl, see Tracer
 this.clipboard = None  # type: Union[tk.BooleanVar, None] # copy system name to clipboard
 this.overwrite = None  # type: Union[tk.BooleanVar, None] # overwrite disabled state (EDSM/EDDN disabled)
 this.edsmBodyCheck = None  # type: Union[tk.BooleanVar, None] # in settings; compare total number of bodies to the number known to EDSM
@@ -82,6 +87,7 @@ this.distanceValue = None  # type: Union[tk.Label, None] # distance to system
 this.actionText = None  # type: Union[tk.Label, None] # task to do
 this.edsmBodyFrame = None  # type: Union[tk.Frame, None] # frame containing all UI elements for EDSM body count
 this.edsmBodyCountText = None  # type: Union[tk.Label, None] # text of information about bodies known to EDSM
+this.connectionLabel = None  # type: Union[tk.Label, None] # shown while remote hosts are unavailable
 this.unconfirmedSystem = None  # type: Union[RseHyperlinkLabel, None] # display name of system that needs checking
 this.updateNotificationLabel = None  # type: Union[HyperlinkLabel, None]
 
@@ -161,10 +167,12 @@ def plugin_start(plugin_dir):
         logger.setLevel(level)
         for handler in logger.handlers:
             handler.setLevel(level)
+    this.trace = tk.BooleanVar(value=((settings >> 9) & 0x01))
+    update_tracer()
     
     this.enabled = check_transmission_options()
 
-    this.queue = Queue()
+    this.queue = TaskQueue()
     this.worker = BackgroundWorker(this.queue, this.rseData)
     this.worker.name = "EDSM-RSE Background Worker"
     this.worker.daemon = True
@@ -180,8 +188,30 @@ def plugin_start3(plugin_dir):
     plugin_start(plugin_dir)
 
 
+def update_tracer():
+    try:
+        if this.trace.get():
+            this.rseData.tracer.enable(this.rseData.plugin_dir)
+        else:
+            this.rseData.tracer.disable()
+    except OSError as e:
+        logger.exception("Failed to open the trace file.")
+
+
+def trace_ui_update(event_name: str, callback: Callable):
+    """
+    Wrap the handler of a virtual event, so the trace of the task that fired the event ends with the update of the UI.
+    The event passed by tkinter doesn't contain the name of the virtual event.
+    """
+    def handler(event=None):
+        if this.rseData.tracer.enabled:
+            this.rseData.tracer.record("ui_update", time.time(), 0.0, this.rseData.last_event_info.get(RseData.BG_TRACE_ID), event=event_name)
+        callback(event)
+    return handler
+
+
 def update_ui_unconfirmed_system(event=None):
-    elite_system = this.rseData.last_event_info.get(RseData.BG_RSE_SYSTEM, None)  # type: EliteSystem
+    elite_system = this.rseData.last_event_info.get(RseData.BG_RSE_SYSTEM, None)
     message = this.rseData.last_event_info.get(RseData.BG_RSE_MESSAGE, None)
     if (this.enabled or this.overwrite.get()) and elite_system:
         this.errorLabel.grid_remove()
@@ -220,6 +250,15 @@ def update_ui_edsm_body_count(event=None):
         this.edsmBodyFrame.grid_remove()
 
 
+def update_ui_connection(event=None):
+    hosts = this.rseData.last_event_info.get(RseData.BG_UNAVAILABLE_HOSTS, None)
+    if hosts:
+        this.connectionLabel["text"] = "Offline: {hosts} (using cached data)".format(hosts=", ".join(hosts))
+        this.connectionLabel.grid(row=98, column=0, columnspan=2, sticky=tk.W)
+    else:
+        this.connectionLabel.grid_remove()
+
+
 def plugin_close():
     # Signal thread to close and wait for it
     this.queue.put(None)
@@ -272,6 +311,8 @@ def plugin_prefs(parent, cmdr, is_beta):
         .grid(padx=PADX, sticky=tk.W, row=0, column=0)
     nb.Button(clearCachesFrame, text="Ignored systems", command=lambda: clear_scanned_systems_cache_callback(RseData.CACHE_IGNORED_SYSTEMS, "ignored systems")) \
         .grid(padx=PADX, sticky=tk.W, row=0, column=1)
+    nb.Button(clearCachesFrame, text="Systems with known coordinates", command=lambda: clear_scanned_systems_cache_callback(RseData.CACHE_COORDINATES_CONFIRMED, "systems with known coordinates")) \
+        .grid(padx=PADX, sticky=tk.W, row=0, column=2)
 
     # links
     ttk.Separator(frame, orient=tk.HORIZONTAL).grid(padx=PADX * 2, pady=8, sticky=tk.EW)
@@ -279,6 +320,8 @@ def plugin_prefs(parent, cmdr, is_beta):
     if not this.edmc_has_logging_support:
         nb.Checkbutton(frame, variable=this.debug,
                        text="Verbose Logging").grid(padx=PADX, sticky=tk.W)
+    nb.Checkbutton(frame, variable=this.trace,
+                   text="Write timings of background tasks to {file} (for troubleshooting)".format(file=Tracer.FILE_NAME)).grid(padx=PADX, sticky=tk.W)
     HyperlinkLabel(frame, text="Open the Github page for this plugin", background=nb.Label().cget("background"),
                    url="https://github.com/Thurion/EDSM-RSE-for-EDMC", underline=True).grid(padx=PADX, sticky=tk.W)
     HyperlinkLabel(frame, text="A big thanks to EDTS for providing the coordinates.", background=nb.Label().cget("background"),
@@ -294,8 +337,11 @@ def prefs_changed(cmdr, is_beta):
     # 7: overwrite enabled status
     # 8: EDSM body check, value inverted
     # 9: Debug
-    settings = (this.clipboard.get() << 5) | (this.overwrite.get() << 6) | ((not this.edsmBodyCheck.get()) << 7) | (this.debug.get() << 8)
+    # 10: Trace
+    settings = (this.clipboard.get() << 5) | (this.overwrite.get() << 6) | ((not this.edsmBodyCheck.get()) << 7) | (this.debug.get() << 8) | \
+               (this.trace.get() << 9)
     config.set(this.CONFIG_MAIN, settings)
+    update_tracer()
     this.enabled = check_transmission_options()
     this.rseData.radius_exponent = RseData.DEFAULT_RADIUS_EXPONENT
 
@@ -309,7 +355,7 @@ def prefs_changed(cmdr, is_beta):
     if old_flags != this.rseData.ignored_projects_flags:
         this.rseData.radius = RseData.DEFAULT_RADIUS_EXPONENT  # reset radius just in case
         if this.currentSystem:
-            this.rseData.system_list = list()  # clear list in case there is no system nearby
+            this.rseData.system_list = SystemTable()  # clear list in case there is no system nearby
             this.queue.put(BackgroundTask.JumpedSystemTask(this.rseData, this.currentSystem))
 
     config.set(this.CONFIG_IGNORED_PROJECTS, this.rseData.ignored_projects_flags)
@@ -342,9 +388,10 @@ def show_update_notification(event=None):
 
 def plugin_app(parent):
     this.frame = tk.Frame(parent)
-    this.frame.bind_all(RseData.EVENT_RSE_BACKGROUNDWORKER, update_ui_unconfirmed_system)
+    this.frame.bind_all(RseData.EVENT_RSE_BACKGROUNDWORKER, trace_ui_update(RseData.EVENT_RSE_BACKGROUNDWORKER, update_ui_unconfirmed_system))
     this.frame.bind_all(RseData.EVENT_RSE_UPDATE_AVAILABLE, show_update_notification)
-    this.frame.bind_all(RseData.EVENT_RSE_EDSM_BODY_COUNT, update_ui_edsm_body_count)
+    this.frame.bind_all(RseData.EVENT_RSE_EDSM_BODY_COUNT, trace_ui_update(RseData.EVENT_RSE_EDSM_BODY_COUNT, update_ui_edsm_body_count))
+    this.frame.bind_all(RseData.EVENT_RSE_CONNECTION, update_ui_connection)
 
     this.rseData.set_frame(this.frame)
 
@@ -369,8 +416,10 @@ def plugin_app(parent):
 
     this.updateNotificationLabel = HyperlinkLabel(this.frame, text="Plugin update available", background=nb.Label().cget("background"),
                                                   url="https://github.com/Thurion/EDSM-RSE-for-EDMC/releases", underline=True)
+    this.connectionLabel = tk.Label(this.frame)
     update_ui_unconfirmed_system()
     update_ui_edsm_body_count()
+    update_ui_connection()
 
     # start update check after frame is initialized to avoid any possible race conditions when generating the event
     this.queue.put(BackgroundTask.VersionCheckTask(this.rseData))
@@ -378,16 +427,65 @@ def plugin_app(parent):
     return this.frame
 
 
+def read_nav_route(entry, state) -> List[EliteSystem]:
+    """
+    Return the plotted route. Older game versions include it in the journal event, newer ones only write NavRoute.json.
+    """
+    route = entry.get("Route")
+    if route is None:
+        route = (state.get("NavRoute") or dict()).get("Route")
+    if route is None:
+        journal_dir = config.get_str("journaldir") or config.default_journal_dir
+        try:
+            with open(os.path.join(journal_dir, "NavRoute.json"), "r", encoding="utf-8") as f:
+                route = json.load(f).get("Route")
+        except (OSError, ValueError) as e:
+            logger.debug("Could not read NavRoute.json.", exc_info=e)
+    return [EliteSystem(hop["SystemAddress"], hop["StarSystem"], *hop["StarPos"]) for hop in route or list()]
+
+
+def prefetch_route_after(system_address: int, include_system: bool):
+    """
+    Let the background worker look up targets for the next hops of the route after (or starting at) the given system.
+    """
+    for index, elite_system in enumerate(this.navRoute):
+        if elite_system.id64 == system_address:
+            start = index if include_system else index + 1
+            hops = this.navRoute[start:start + RseData.PREFETCH_HOPS]
+            if len(hops) > 0:
+                this.queue.put(BackgroundTask.PrefetchTask(this.rseData, hops))
+            return
+
+
+def prefetch_body_count(system_address: int, system_name: str):
+    """
+    Get the number of bodies known to EDSM in the background, so it can be shown right after the discovery scan.
+    """
+    if this.edsmBodyCheck.get() and system_address not in this.rseData.get_cached_set(RseData.CACHE_FULLY_SCANNED_BODIES):
+        this.queue.put(BackgroundTask.BodyCountPrefetchTask(this.rseData, system_address, system_name))
+
+
 def journal_entry(cmdr, is_beta, system, station, entry, state):
     if not this.enabled and not this.overwrite.get() or is_beta:
         return  # nothing to do here
 
+    tracer = this.rseData.tracer
+    if tracer.enabled:
+        with tracer.trace(tracer.new_trace_id()):  # tasks created for this entry carry the ID, see BackgroundTask.trace_id
+            tracer.event("journal_entry", event=entry["event"], system=system)
+            handle_journal_entry(cmdr, system, entry, state)
+    else:
+        handle_journal_entry(cmdr, system, entry, state)
+
+
+def handle_journal_entry(cmdr, system, entry, state):
     if this.commander != cmdr:
         # user switched commanders, reset the list of systems
         logger.debug("New commander detected: {cmdr}; resetting radius and clearing nearby systems.".format(cmdr=cmdr))
         this.commander = cmdr
-        this.rseData.system_list = list()
+        this.rseData.system_list = SystemTable()
         this.rseData.radius_exponent = RseData.DEFAULT_RADIUS_EXPONENT
+        this.rseData.radius_controller.reset()
 
     if entry["event"] in ["FSDJump", "Location", "CarrierJump", "StartUp"]:
         if entry["SystemAddress"] in this.rseData.get_cached_set(RseData.CACHE_FULLY_SCANNED_BODIES):
@@ -396,13 +494,30 @@ def journal_entry(cmdr, is_beta, system, station, entry, state):
         else:
             this.edsmBodyCountText["text"] = "Use discovery scanner"
             this.systemScanned = False
+            prefetch_body_count(entry["SystemAddress"], entry["StarSystem"])
         if "StarPos" in entry:
             this.currentSystem = EliteSystem(entry["SystemAddress"], entry["StarSystem"], *entry["StarPos"])
             this.queue.put(BackgroundTask.JumpedSystemTask(this.rseData, this.currentSystem))
 
+    if entry["event"] == "NavRoute":
+        this.navRoute = read_nav_route(entry, state)
+        if this.currentSystem:
+            prefetch_route_after(this.currentSystem.id64, False)
+
+    if entry["event"] == "NavRouteClear":
+        this.navRoute = list()
+
+    if entry["event"] == "FSDTarget":
+        prefetch_route_after(entry["SystemAddress"], True)
+        prefetch_body_count(entry["SystemAddress"], entry["Name"])
+
+    if entry["event"] == "StartJump" and entry.get("JumpType") == "Hyperspace":
+        prefetch_route_after(entry["SystemAddress"], True)
+        prefetch_body_count(entry["SystemAddress"], entry["StarSystem"])
+
     if entry["event"] == "Resurrect":
         # reset radius in case someone died in an area where there are not many available stars (meaning very large radius)
-        this.rseData.system_list = list()
+        this.rseData.system_list = SystemTable()
         this.rseData.radius = RseData.DEFAULT_RADIUS_EXPONENT
 
     if entry["event"] == "NavBeaconScan":
@@ -413,7 +528,7 @@ def journal_entry(cmdr, is_beta, system, station, entry, state):
             if this.systemCreated:
                 this.edsmBodyCountText["text"] = "0/{}".format(entry["BodyCount"])
             else:
-                this.queue.put(BackgroundTask.FSSDiscoveryScanTask(this.rseData, system, entry["BodyCount"], entry["Progress"]))
+                this.queue.put(BackgroundTask.FSSDiscoveryScanTask(this.rseData, entry["SystemAddress"], system, entry["BodyCount"], entry["Progress"]))
         this.systemScanned = True
 
     if entry["event"] == "FSSAllBodiesFound":